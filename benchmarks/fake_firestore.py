@@ -0,0 +1,83 @@
+from typing import Any, Dict, Optional, Set, Tuple
+
+from storage import StorageClient, comparable, get_field, hashable
+
+
+# In-memory storage backend standing in for google.cloud.firestore.AsyncClient. Stored documents are
+# replaced on every write and never mutated, so snapshots can share them. Equality filters are served
+# from per-field indexes built on first use, so query cost tracks the result size as it does in
+# Firestore rather than the collection size.
+
+
+class FakeAsyncClient(StorageClient):
+    def __init__(self, project: str = "benchmark"):
+        super().__init__(project)
+        self._collections: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._indexes: Dict[Tuple[str, str], Dict[Any, Set[str]]] = {}
+
+    def _collection(self, path):
+        return self._collections.setdefault(path.rsplit("/", 1)[0], {})
+
+    def _read_many(self, paths):
+        with self._lock:
+            documents = {path: self._collection(path).get(path) for path in paths}
+        return {path: data for path, data in documents.items() if data is not None}
+
+    def _write_many(self, changes):
+        with self._lock:
+            for path, data in changes.items():
+                documents = self._collection(path)
+                existing = documents.pop(path, None)
+                if data is not None:
+                    documents[path] = data
+                self._reindex(path, existing, data)
+
+    def _candidates(self, collection_path, filters):
+        with self._lock:
+            documents = self._collections.get(collection_path, {})
+            for field, op, value in filters:
+                value = comparable(value)
+                if op == "==" and hashable(value):
+                    paths = self._index(collection_path, field).get(value, ())
+                    return [(path, documents[path]) for path in paths]
+            return list(documents.items())
+
+    def _index(self, collection_path, field):
+        index = self._indexes.get((collection_path, field))
+        if index is None:
+            index = {}
+            for path, data in self._collections.get(collection_path, {}).items():
+                self._index_add(index, field, path, data)
+            self._indexes[(collection_path, field)] = index
+        return index
+
+    @staticmethod
+    def _index_add(index, field, path, data):
+        try:
+            value = comparable(get_field(data, field))
+        except KeyError:
+            return
+        if hashable(value):
+            index.setdefault(value, set()).add(path)
+
+    @staticmethod
+    def _index_discard(index, field, path, data):
+        try:
+            value = comparable(get_field(data, field))
+        except KeyError:
+            return
+        if hashable(value) and value in index:
+            index[value].discard(path)
+
+    def _reindex(self, path: str, old: Optional[Dict[str, Any]], new: Optional[Dict[str, Any]]):
+        collection_path = path.rsplit("/", 1)[0]
+        for (indexed_collection, field), index in self._indexes.items():
+            if indexed_collection == collection_path:
+                if old is not None:
+                    self._index_discard(index, field, path, old)
+                if new is not None:
+                    self._index_add(index, field, path, new)
+
+    def seed(self, path, data):
+        # Stores data as given, without notifying listeners; the caller must not modify it afterwards.
+        self._write_many({path: data})
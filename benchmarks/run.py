@@ -0,0 +1,267 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+BASELINES_PATH = Path(__file__).resolve().parent / "baselines.json"
+
+# Relative slack before a metric counts as a regression. Document reads are deterministic, so any
+# increase fails; latency and throughput depend on the machine and get wider margins, p99 the widest.
+DEFAULT_TOLERANCES = {"reads": 0.0, "p50_ms": 0.5, "p99_ms": 1.0, "throughput_rps": 0.35}
+LATENCY_NOISE_FLOOR_MS = 2.0
+
+
+def configure_environment(backend: str):
+    os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "benchmark")
+    os.environ.setdefault("ANSWER_CACHE_PATH", os.path.join(tempfile.mkdtemp(prefix="benchmark-"), "answers.sqlite3"))
+    os.environ.setdefault("MAPS_DATA_STORE_TIMEOUT", "3600")
+    if backend == "sqlite":
+        os.environ["STORAGE_BACKEND"] = "sqlite"
+        os.environ["ANALYTICS_STORAGE_BACKEND"] = "sqlite"
+        os.environ["SQLITE_STORAGE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="benchmark-"), "storage.sqlite3")
+    elif backend == "emulator" and "FIRESTORE_EMULATOR_HOST" not in os.environ:
+        sys.exit("--backend emulator needs FIRESTORE_EMULATOR_HOST, e.g. localhost:8080")
+
+
+def city_point(dataset, rnd: random.Random):
+    country = rnd.choice(sorted(dataset.cities))
+    _, lat, lng = rnd.choice(dataset.cities[country])
+    return country, lat, lng
+
+
+def task_payload(dataset, rnd: random.Random, i: int) -> Dict[str, Any]:
+    organization_id = rnd.choice(dataset.organizations)
+    users = dataset.users[organization_id]
+    return {
+        "title": f"Benchmark task {i}",
+        "status": "todo",
+        "expected_outcome": "Measured",
+        "assigned_to_id": rnd.choice(users),
+        "created_by_id": rnd.choice(users),
+        "department_id": rnd.choice(dataset.departments[organization_id]),
+        "organization_id": organization_id,
+    }
+
+
+def bounds_params(dataset, rnd: random.Random) -> Dict[str, Any]:
+    country, lat, lng = city_point(dataset, rnd)
+    return {"country": country, "min_lat": lat - 0.1, "min_lng": lng - 0.1, "max_lat": lat + 0.1, "max_lng": lng + 0.1}
+
+
+def near_params(dataset, rnd: random.Random) -> Dict[str, Any]:
+    country, lat, lng = city_point(dataset, rnd)
+    return {"country": country, "lat": lat, "lng": lng, "radius_km": 5}
+
+
+# name -> (method, path, builder(dataset, rnd, i) returning httpx request kwargs). Writes come last so
+# they do not change the data the read scenarios measure.
+SCENARIOS = {
+    "roles": ("GET", "/get-roles", lambda d, rnd, i: {}),
+    "organization-info": ("GET", "/get-organization-info", lambda d, rnd, i: {
+        "params": {"organization_id": rnd.choice(d.organizations)}}),
+    "user-info": ("GET", "/get-user-info", lambda d, rnd, i: {"params": {"user_id": rnd.choice(d.auth_ids)}}),
+    "tasks-page": ("GET", "/get-tasks-by-organization", lambda d, rnd, i: {
+        "params": {"organization_id": rnd.choice(d.organizations), "sort": "title", "limit": 50}}),
+    "tasks-all": ("GET", "/get-tasks-by-organization", lambda d, rnd, i: {
+        "params": {"organization_id": rnd.choice(d.organizations), "resolve": "none"}}),
+    "task-stats": ("GET", "/get-task-stats", lambda d, rnd, i: {"params": {"organization_id": rnd.choice(d.organizations)}}),
+    "workflows": ("GET", "/get-workflows-by-organization", lambda d, rnd, i: {
+        "params": {"organization_id": rnd.choice(d.organizations)}}),
+    "workflow-graph": ("GET", "/get-workflow-graph", lambda d, rnd, i: {"params": {"workflow_id": rnd.choice(d.workflows)}}),
+    "user-messages": ("GET", "/get-user-messages", lambda d, rnd, i: {
+        "params": {"user_id": rnd.choice(d.answer_users)}}),
+    "products-page": ("GET", "/get-products", lambda d, rnd, i: {"params": {"country": rnd.choice(sorted(d.cities)), "limit": 1000}}),
+    "points-in-bounds": ("GET", "/points-in-bounds", lambda d, rnd, i: {"params": bounds_params(d, rnd)}),
+    "points-near": ("GET", "/points-near", lambda d, rnd, i: {"params": near_params(d, rnd)}),
+    "country-index": ("GET", "/country-index", lambda d, rnd, i: {"params": {"country": rnd.choice(sorted(d.cities))}}),
+    "zones-summary": ("GET", "/distribution-zones/summary", lambda d, rnd, i: {"params": {"country": rnd.choice(sorted(d.cities))}}),
+    "zones-clusters": ("GET", "/distribution-zones", lambda d, rnd, i: {
+        "params": {"country": rnd.choice(sorted(d.cities)), "zoom": 8, "include_points": "false"}}),
+    "chat-cached": ("POST", "/get-answer-to-chat", lambda d, rnd, i: {
+        "json": {"message": "Plan the weekly restock", "user_id": rnd.choice(d.users[d.organizations[0]])}}),
+    "chat": ("POST", "/get-answer-to-chat", lambda d, rnd, i: {
+        "json": {"message": f"Plan restock number {i} {rnd.random()}", "user_id": rnd.choice(d.users[d.organizations[0]])}}),
+    "create-task": ("POST", "/create-task", lambda d, rnd, i: {"json": task_payload(d, rnd, i)}),
+}
+
+
+def documents_read(route: str) -> float:
+    from prometheus_client import REGISTRY
+
+    return REGISTRY.get_sample_value("firestore_documents_per_request_sum", {"route": route, "operation": "reads"}) or 0.0
+
+
+async def measure_round(http, method: str, path: str, requests: List[Dict[str, Any]], concurrency: int, errors: List[str]):
+    pending = iter(requests)
+    latencies: List[float] = []
+
+    async def worker():
+        for kwargs in pending:
+            started = time.perf_counter()
+            response = await http.request(method, path, **kwargs)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors.append(f"{response.status_code} {response.text[:200]}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies_ms = np.array(latencies) * 1000
+    return len(requests) / elapsed, np.percentile(latencies_ms, 50), np.percentile(latencies_ms, 99)
+
+
+async def run_scenario(http, dataset, name: str, args) -> Dict[str, Any]:
+    method, path, build = SCENARIOS[name]
+    rnd = random.Random(args.seed)
+    for i in range(args.warmup):
+        await http.request(method, path, **build(dataset, rnd, -i - 1))
+
+    # Requests are built up front so every run sends the same sequence regardless of scheduling, and each
+    # metric is the median over the rounds to damp scheduler and GC noise.
+    errors: List[str] = []
+    rounds = []
+    reads_before = documents_read(path)
+    for round_index in range(args.rounds):
+        requests = [build(dataset, rnd, round_index * args.requests + i) for i in range(args.requests)]
+        rounds.append(await measure_round(http, method, path, requests, args.concurrency, errors))
+    throughput, p50, p99 = np.median(np.array(rounds), axis=0)
+
+    return {
+        "requests": args.requests * args.rounds,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "throughput_rps": round(float(throughput), 1),
+        "p50_ms": round(float(p50), 2),
+        "p99_ms": round(float(p99), 2),
+        "reads_per_request": round((documents_read(path) - reads_before) / (args.requests * args.rounds), 2),
+    }
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]], tolerances: Dict[str, float]) -> List[str]:
+    regressions = []
+    for name, result in results.items():
+        if result["errors"]:
+            regressions.append(f"{name}: {result['errors']} failed requests, first: {result['first_error']}")
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        if result["reads_per_request"] > expected["reads_per_request"] * (1 + tolerances["reads"]) + 1e-9:
+            regressions.append(f"{name}: reads/request {expected['reads_per_request']} -> {result['reads_per_request']}")
+        for metric in ("p50_ms", "p99_ms"):
+            limit = expected[metric] * (1 + tolerances[metric])
+            if result[metric] > limit and result[metric] - expected[metric] > LATENCY_NOISE_FLOOR_MS:
+                regressions.append(f"{name}: {metric} {expected[metric]} -> {result[metric]}")
+        if result["throughput_rps"] < expected["throughput_rps"] * (1 - tolerances["throughput_rps"]):
+            regressions.append(f"{name}: throughput {expected['throughput_rps']} -> {result['throughput_rps']} req/s")
+    return regressions
+
+
+def print_table(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]]):
+    header = f"{'scenario':<20}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'reads':>10}{'errors':>8}   baseline p99 / reads"
+    print(header)
+    print("-" * len(header))
+    for name, result in results.items():
+        expected = baseline.get(name)
+        reference = f"{expected['p99_ms']} / {expected['reads_per_request']}" if expected else "-"
+        print(
+            f"{name:<20}{result['throughput_rps']:>10}{result['p50_ms']:>10}{result['p99_ms']:>10}"
+            f"{result['reads_per_request']:>10}{result['errors']:>8}   {reference}"
+        )
+
+
+async def benchmark(args) -> Dict[str, Dict[str, Any]]:
+    import httpx
+
+    import main
+    from benchmarks.seed import Dataset, load_fake, load_firestore
+    from benchmarks.stub_openai import StubAsyncOpenAI
+
+    dataset = Dataset(args.size)
+    started = time.perf_counter()
+    if args.backend == "fake":
+        from benchmarks.fake_firestore import FakeAsyncClient
+
+        from repositories import StorageRepository
+
+        fake = FakeAsyncClient()
+        main.repository = StorageRepository(fake)
+        documents = load_fake(fake, dataset)
+    else:
+        main.repository = main.create_storage_repository()
+        documents = await load_firestore(main.repository.client, dataset)
+    print(f"seeded {documents} documents ({args.size}) in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+    # Clients set before startup are kept by the app's lifespan, which instruments and warms them up.
+    main.client = StubAsyncOpenAI(latency=args.openai_latency)
+
+    async with main.app.router.lifespan_context(main.app):
+        started = time.perf_counter()
+        await main.get_maps_data_store()
+        print(f"maps_data store ready in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as http:
+            results = {}
+            for name in args.scenarios:
+                results[name] = await run_scenario(http, dataset, name, args)
+                print(f"{name}: {results[name]['throughput_rps']} req/s", file=sys.stderr)
+    return results
+
+
+def main_cli(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the API against seeded in-memory or emulator Firestore data.")
+    parser.add_argument("--size", choices=("small", "medium", "large"), default="small")
+    parser.add_argument("--backend", choices=("fake", "sqlite", "emulator"), default="fake")
+    parser.add_argument("--scenario", dest="scenarios", action="append", choices=list(SCENARIOS),
+                        help="Scenario to run, repeatable (default: all)")
+    parser.add_argument("--requests", type=int, default=100, help="Measured requests per round")
+    parser.add_argument("--rounds", type=int, default=5, help="Measured rounds per scenario, metrics are their median")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=10, help="Unmeasured requests per scenario")
+    parser.add_argument("--openai-latency", type=float, default=0.05, help="Seconds the stub OpenAI client waits per call")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--update-baseline", action="store_true", help="Store these results as the new baseline")
+    parser.add_argument("--baselines", default=str(BASELINES_PATH))
+    args = parser.parse_args(argv)
+    args.scenarios = args.scenarios or list(SCENARIOS)
+
+    configure_environment(args.backend)
+    results = asyncio.run(benchmark(args))
+
+    baselines_path = Path(args.baselines)
+    baselines = json.loads(baselines_path.read_text()) if baselines_path.exists() else {}
+    tolerances = {**DEFAULT_TOLERANCES, **baselines.get("tolerances", {})}
+    key = f"{args.backend}-{args.size}"
+    baseline = baselines.get(key, {})
+
+    print_table(results, baseline)
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2) + "\n")
+
+    if args.update_baseline:
+        baselines["tolerances"] = tolerances
+        baselines[key] = {**baseline, **{
+            name: {metric: result[metric] for metric in ("throughput_rps", "p50_ms", "p99_ms", "reads_per_request")}
+            for name, result in results.items()
+        }}
+        baselines_path.write_text(json.dumps(baselines, indent=2, sort_keys=True) + "\n")
+        print(f"baseline {key} updated", file=sys.stderr)
+        return 0
+
+    regressions = compare(results, baseline, tolerances)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
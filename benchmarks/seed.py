@@ -0,0 +1,191 @@
+import datetime
+import random
+from typing import Any, Dict, Iterator, List, Tuple
+
+from google.cloud import firestore
+
+
+# Deterministic datasets shaped like production: organizations with departments, users and tasks,
+# workflows with large node/edge graphs, chatbot history and maps_data rows clustered around cities.
+
+SIZES = {
+    "small": {
+        "organizations": 3, "departments": 4, "users": 25, "tasks": 300, "workflows": 4,
+        "nodes": 200, "edges": 250, "answers": 20, "maps_data": 10_000,
+    },
+    "medium": {
+        "organizations": 10, "departments": 8, "users": 100, "tasks": 2_000, "workflows": 10,
+        "nodes": 2_000, "edges": 2_500, "answers": 100, "maps_data": 100_000,
+    },
+    "large": {
+        "organizations": 20, "departments": 12, "users": 250, "tasks": 10_000, "workflows": 20,
+        "nodes": 10_000, "edges": 12_500, "answers": 250, "maps_data": 1_000_000,
+    },
+}
+
+ROLES = ("admin", "manager", "member")
+TASK_STATUSES = ("todo", "in_progress", "done")
+COUNTRIES = {
+    "CO": (4.65, -74.08),
+    "MX": (19.43, -99.13),
+    "PE": (-12.05, -77.04),
+    "EC": (-0.18, -78.47),
+}
+CITIES_PER_COUNTRY = 6
+ROUTES_PER_CITY = 25
+DISTRIBUTOR_TYPES = ("shop", "supermarket", "wholesaler", "kiosk")
+ISOCRONAS = ("5", "10", "15", "30")
+ANSWERS_START = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class Dataset:
+    def __init__(self, size: str):
+        self.size = size
+        self.counts = SIZES[size]
+        self.organizations: List[str] = []
+        self.departments: Dict[str, List[str]] = {}
+        self.users: Dict[str, List[str]] = {}
+        self.auth_ids: List[str] = []
+        self.answer_users: List[str] = []
+        self.workflows: List[str] = []
+        self.cities: Dict[str, List[Tuple[str, float, float]]] = {}
+
+    def documents(self, client, seed: int = 7) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        rnd = random.Random(seed)
+        counts = self.counts
+        ref = client.document
+
+        for role in ROLES:
+            yield f"roles/{role}", {"name": role.title()}
+
+        for o in range(counts["organizations"]):
+            organization_id = f"org{o:03d}"
+            self.organizations.append(organization_id)
+            organization = ref(f"organizations/{organization_id}")
+            yield f"organizations/{organization_id}", {"name": f"Organization {o}", "admin_id": ref(f"users/{organization_id}-u000")}
+
+            departments = [f"{organization_id}-d{d:02d}" for d in range(counts["departments"])]
+            self.departments[organization_id] = departments
+            for d, department_id in enumerate(departments):
+                yield f"departments/{department_id}", {"name": f"Department {d}", "organization": organization}
+
+            users = [f"{organization_id}-u{u:03d}" for u in range(counts["users"])]
+            self.users[organization_id] = users
+            for u, user_id in enumerate(users):
+                auth_id = f"auth-{user_id}"
+                self.auth_ids.append(auth_id)
+                yield f"users/{user_id}", {
+                    "name": f"User {u}",
+                    "email": f"{user_id}@example.com",
+                    "user_id": auth_id,
+                    "role": ref(f"roles/{ROLES[0] if u == 0 else rnd.choice(ROLES[1:])}"),
+                    "organization": organization,
+                    "department": ref(f"departments/{rnd.choice(departments)}"),
+                }
+
+            for t in range(counts["tasks"]):
+                yield f"tasks/{organization_id}-t{t:05d}", {
+                    "title": f"Task {t:05d}",
+                    "status": rnd.choice(TASK_STATUSES),
+                    "expected_outcome": f"Outcome for task {t}",
+                    "assigned_to": ref(f"users/{rnd.choice(users)}"),
+                    "created_by": ref(f"users/{rnd.choice(users)}"),
+                    "department": ref(f"departments/{rnd.choice(departments)}"),
+                    "organization": organization,
+                }
+
+            for w in range(counts["workflows"]):
+                workflow_id = f"{organization_id}-w{w:02d}"
+                self.workflows.append(workflow_id)
+                workflow = ref(f"workflows/{workflow_id}")
+                yield f"workflows/{workflow_id}", {
+                    "title": f"Workflow {w}",
+                    "description": f"Workflow {w} of organization {o}",
+                    "created_by": ref(f"users/{rnd.choice(users)}"),
+                    "organization": organization,
+                    "graph_version": 0,
+                }
+                yield from self._graph(workflow_id, workflow, rnd)
+
+            for a in range(counts["answers"]):
+                user_id = rnd.choice(users)
+                self.answer_users.append(user_id)
+                yield f"ia_answers/{organization_id}-a{a:04d}", {
+                    "ia_answer": "[]",
+                    "user": ref(f"users/{user_id}"),
+                    "user_message": f"Question {a}",
+                    "created_at": ANSWERS_START + datetime.timedelta(minutes=a),
+                }
+
+        yield from self._maps_data(rnd)
+
+    def _graph(self, workflow_id: str, workflow, rnd: random.Random) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        node_ids = [f"{workflow_id}-n{n:05d}" for n in range(self.counts["nodes"])]
+        for n, node_id in enumerate(node_ids):
+            position = {"x": (n % 50) * 180, "y": (n // 50) * 120}
+            yield f"nodes/{node_id}", {
+                "type": "default",
+                "position": position,
+                "data": {"label": f"Step {n}"},
+                "width": 150,
+                "height": 40,
+                "selected": False,
+                "positionAbsolute": position,
+                "dragging": False,
+                "workflow": workflow,
+            }
+        for e in range(self.counts["edges"]):
+            source = node_ids[e % len(node_ids)]
+            target = node_ids[(e + 1) % len(node_ids)] if e < len(node_ids) else rnd.choice(node_ids)
+            yield f"edges/{workflow_id}-e{e:05d}", {
+                "source": source,
+                "sourceHandle": None,
+                "target": target,
+                "targetHandle": None,
+                "workflow": workflow,
+            }
+
+    def _maps_data(self, rnd: random.Random) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        for country, (lat, lng) in COUNTRIES.items():
+            self.cities[country] = [
+                (f"{country}-City{c}", lat + rnd.uniform(-3, 3), lng + rnd.uniform(-3, 3))
+                for c in range(CITIES_PER_COUNTRY)
+            ]
+        countries = list(COUNTRIES)
+        for i in range(self.counts["maps_data"]):
+            country = countries[i % len(countries)]
+            city, lat, lng = rnd.choice(self.cities[country])
+            units = rnd.randint(1, 200)
+            yield f"maps_data/m{i:07d}", {
+                "country": country,
+                "city": city,
+                "route": f"{city}-R{rnd.randrange(ROUTES_PER_CITY):02d}",
+                "distributor_type": rnd.choice(DISTRIBUTOR_TYPES),
+                "isocrona": rnd.choice(ISOCRONAS),
+                "sales_units": units,
+                "sales_liters": round(units * rnd.uniform(0.3, 2.0), 2),
+                "sales_usd": round(units * rnd.uniform(0.5, 4.0), 2),
+                "gps_coordinates": firestore.GeoPoint(lat + rnd.gauss(0, 0.05), lng + rnd.gauss(0, 0.05)),
+            }
+
+
+def load_fake(fake, dataset: Dataset) -> int:
+    count = 0
+    for path, data in dataset.documents(fake):
+        fake.seed(path, data)
+        count += 1
+    return count
+
+
+async def load_firestore(client, dataset: Dataset, batch_size: int = 500) -> int:
+    count = 0
+    batch = client.batch()
+    for path, data in dataset.documents(client):
+        batch.set(client.document(path), data)
+        count += 1
+        if count % batch_size == 0:
+            await batch.commit()
+            batch = client.batch()
+    if count % batch_size:
+        await batch.commit()
+    return count
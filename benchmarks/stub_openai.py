@@ -0,0 +1,89 @@
+import asyncio
+import json
+import time
+import uuid
+from types import SimpleNamespace
+
+from openai.types import Model
+from openai.types.chat import ChatCompletion, ChatCompletionChunk, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+from openai.types.chat.chat_completion_chunk import Choice as ChunkChoice, ChoiceDelta
+from openai.types.completion_usage import CompletionUsage
+
+
+# Drop-in for the parts of AsyncOpenAI the app uses: chat completions answer in the shape CHAT_SYSTEM_PROMPT asks for after a
+# fixed latency, so chatbot endpoints can be benchmarked without network access or cost.
+
+
+def workflow_answer(message: str) -> str:
+    return json.dumps([
+        {
+            "name": f"Workflow {index + 1}",
+            "description": f"Approach {index + 1} for: {message}",
+            "steps": [f"Step {step + 1}" for step in range(4)],
+        }
+        for index in range(5)
+    ])
+
+
+class StubCompletions:
+    def __init__(self, latency: float, chunk_size: int):
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.calls = 0
+
+    async def create(self, *, model, messages, stream=False, stream_options=None, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        content = workflow_answer(messages[-1]["content"])
+        usage = CompletionUsage(
+            prompt_tokens=sum(len(message["content"]) for message in messages) // 4,
+            completion_tokens=len(content) // 4,
+            total_tokens=(sum(len(message["content"]) for message in messages) + len(content)) // 4,
+        )
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        if not stream:
+            return ChatCompletion(
+                id=completion_id,
+                created=int(time.time()),
+                model=model,
+                object="chat.completion",
+                choices=[Choice(index=0, finish_reason="stop", message=ChatCompletionMessage(role="assistant", content=content))],
+                usage=usage,
+            )
+        include_usage = bool((stream_options or {}).get("include_usage"))
+        return self._stream(completion_id, model, content, usage if include_usage else None)
+
+    async def _stream(self, completion_id, model, content, usage):
+        created = int(time.time())
+        for start in range(0, len(content), self.chunk_size):
+            yield ChatCompletionChunk(
+                id=completion_id,
+                created=created,
+                model=model,
+                object="chat.completion.chunk",
+                choices=[ChunkChoice(index=0, delta=ChoiceDelta(content=content[start:start + self.chunk_size]))],
+            )
+            await asyncio.sleep(0)
+        yield ChatCompletionChunk(
+            id=completion_id,
+            created=created,
+            model=model,
+            object="chat.completion.chunk",
+            choices=[ChunkChoice(index=0, delta=ChoiceDelta(), finish_reason="stop")],
+        )
+        if usage is not None:
+            yield ChatCompletionChunk(
+                id=completion_id, created=created, model=model, object="chat.completion.chunk", choices=[], usage=usage
+            )
+
+
+class StubModels:
+    async def retrieve(self, model: str) -> Model:
+        return Model(id=model, created=0, object="model", owned_by="benchmark")
+
+
+class StubAsyncOpenAI:
+    def __init__(self, latency: float = 0.05, chunk_size: int = 16):
+        self.chat = SimpleNamespace(completions=StubCompletions(latency, chunk_size))
+        self.models = StubModels()
@@ -1,30 +1,612 @@
 import os
-from fastapi import FastAPI, HTTPException, Body
+from fastapi import FastAPI, HTTPException, Body, BackgroundTasks, Depends, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from openai import OpenAI
+from fastapi.responses import StreamingResponse
+from fastapi.routing import APIRoute
+from starlette.datastructures import Headers, MutableHeaders
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+from google.api_core import exceptions
 from google.cloud import firestore
 from dotenv import load_dotenv
 import asyncio
-from typing import List, Dict, Any
+import base64
+import contextvars
+import datetime
+import functools
+import gzip
+import hashlib
+import json
+import math
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import List, Dict, Any, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import msgpack
+import numpy as np
+import orjson
+
+from repositories import FirestoreRepository, StorageRepository, create_repository
+from storage import STORAGE_BACKENDS, SQLiteClient
 
 load_dotenv()
 
-credentials_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
-if not credentials_path:
-    raise Exception("GOOGLE_APPLICATION_CREDENTIALS is not defined in the environment variables.")
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "firestore")
+ANALYTICS_STORAGE_BACKEND = os.getenv("ANALYTICS_STORAGE_BACKEND", STORAGE_BACKEND)
+SQLITE_STORAGE_PATH = os.getenv("SQLITE_STORAGE_PATH", "storage.sqlite3")
+FIRESTORE_CHANNELS = int(os.getenv("FIRESTORE_CHANNELS", "4"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "50"))
+OPENAI_KEEPALIVE_EXPIRY = 30.0
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "120"))
 
-api_key = os.getenv("OPENAI_API_KEY")
-if not api_key:
-    raise Exception("OPENAI_API_KEY is not defined in the environment variables.")
+# Built by the lifespan on startup unless already set, so importing this module needs no credentials and
+# tests or benchmarks can install their own clients before the app starts.
+client = None
+repository = None
 
-client = OpenAI(
-    api_key= api_key
+
+def create_storage_repository():
+    if {STORAGE_BACKEND, ANALYTICS_STORAGE_BACKEND} - set(STORAGE_BACKENDS):
+        raise Exception(f"STORAGE_BACKEND and ANALYTICS_STORAGE_BACKEND must be one of: {', '.join(STORAGE_BACKENDS)}.")
+
+    credentials_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+    if not credentials_path and not os.getenv("FIRESTORE_EMULATOR_HOST") and "firestore" in (STORAGE_BACKEND, ANALYTICS_STORAGE_BACKEND):
+        raise Exception("GOOGLE_APPLICATION_CREDENTIALS is not defined in the environment variables.")
+
+    return create_repository(STORAGE_BACKEND, SQLITE_STORAGE_PATH, channels=FIRESTORE_CHANNELS)
+
+
+def create_openai_client():
+    import httpx
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise Exception("OPENAI_API_KEY is not defined in the environment variables.")
+
+    limits = httpx.Limits(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+    )
+    return AsyncOpenAI(
+        api_key=api_key,
+        timeout=OPENAI_TIMEOUT,
+        http_client=DefaultAsyncHttpxClient(limits=limits, timeout=OPENAI_TIMEOUT),
+    )
+
+
+# -------------------------------------------------------------- RESPONSES --------------------------------------------------------------
+RESPONSE_MEDIA_TYPES = {
+    "application/json": "json",
+    "application/msgpack": "msgpack",
+    "application/x-msgpack": "msgpack",
+    "application/vnd.msgpack": "msgpack",
+    "application/vnd.apache.arrow.stream": "arrow",
+    "application/x-ndjson": "ndjson",
+}
+RESPONSE_CONTENT_TYPES = {
+    "json": "application/json",
+    "msgpack": "application/msgpack",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "ndjson": "application/x-ndjson",
+}
+
+negotiation_context = contextvars.ContextVar("negotiation_context", default=None)
+
+
+def encode_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, (firestore.AsyncDocumentReference, firestore.DocumentReference)):
+        return value.path
+    if isinstance(value, firestore.GeoPoint):
+        return {"latitude": value.latitude, "longitude": value.longitude}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode()
+    return str(value)
+
+
+def dumps_json(content) -> bytes:
+    return orjson.dumps(content, default=encode_value, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+
+
+@functools.lru_cache(maxsize=1)
+def arrow_module():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+    except ImportError:
+        return None
+    return pyarrow
+
+
+def accepted_values(header: Optional[str]) -> List[str]:
+    ranked = []
+    for position, item in enumerate((header or "").split(",")):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if media_type and quality > 0:
+            ranked.append((-quality, position, media_type.lower()))
+    return [media_type for _, _, media_type in sorted(ranked)]
+
+
+def negotiate_format(request: Request, tabular: bool = False) -> str:
+    for media_type in accepted_values(request.headers.get("accept")):
+        if media_type in ("*/*", "application/*"):
+            return "json"
+        response_format = RESPONSE_MEDIA_TYPES.get(media_type)
+        if response_format in ("arrow", "ndjson") and not tabular:
+            continue
+        if response_format == "arrow" and arrow_module() is None:
+            continue
+        if response_format:
+            return response_format
+    return "json"
+
+
+def arrow_table_bytes(content: Dict[str, Any], key: str) -> bytes:
+    pyarrow = arrow_module()
+    rows = [
+        {
+            field: value if isinstance(value, (str, int, float, bool, list, dict, datetime.datetime, type(None)))
+            else encode_value(value)
+            for field, value in row.items()
+        }
+        for row in content[key]
+    ]
+    table = pyarrow.Table.from_pylist(rows)
+    table = table.replace_schema_metadata({
+        field: dumps_json(value) for field, value in content.items() if field != key
+    })
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def render_response(content, response_format: str, tabular_key: Optional[str] = None) -> Response:
+    if response_format == "arrow" and tabular_key:
+        pyarrow = arrow_module()
+        try:
+            return Response(arrow_table_bytes(content, tabular_key), media_type=RESPONSE_CONTENT_TYPES["arrow"])
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, pyarrow.ArrowNotImplementedError):
+            pass
+    if response_format == "msgpack":
+        body = msgpack.packb(content, default=encode_value, use_bin_type=True, datetime=False)
+        return Response(body, media_type=RESPONSE_CONTENT_TYPES["msgpack"])
+    return Response(dumps_json(content), media_type=RESPONSE_CONTENT_TYPES["json"])
+
+
+def tabular(key: str):
+    # Marks an endpoint whose response holds its rows under `key`, which makes it eligible for Arrow
+    # and NDJSON output.
+    def decorator(endpoint):
+        endpoint.tabular_key = key
+        return endpoint
+    return decorator
+
+
+async def capture_negotiation(request: Request, response: Response):
+    negotiation_context.set((request, response))
+
+
+class NegotiatedRoute(APIRoute):
+    # Endpoints keep returning plain dicts; the route renders them itself in the format picked from the
+    # Accept header, which skips FastAPI's jsonable_encoder pass.
+    def __init__(self, path: str, endpoint, **kwargs):
+        kwargs["dependencies"] = [*(kwargs.get("dependencies") or []), Depends(capture_negotiation)]
+        super().__init__(path, self.negotiated(endpoint, kwargs.get("status_code")), **kwargs)
+
+    @staticmethod
+    def negotiated(endpoint, status_code: Optional[int]):
+        tabular_key = getattr(endpoint, "tabular_key", None)
+
+        @functools.wraps(endpoint)
+        async def negotiated_endpoint(*args, **kwargs):
+            content = await endpoint(*args, **kwargs)
+            if isinstance(content, Response):
+                return content
+
+            request, sub_response = negotiation_context.get()
+            response = render_response(content, negotiate_format(request, tabular_key is not None), tabular_key)
+            response.status_code = sub_response.status_code or status_code or 200
+            response.headers.raw.extend(sub_response.headers.raw)
+            response.headers["Vary"] = "Accept"
+            if response.status_code in (204, 304) or response.status_code < 200:
+                response.body = b""
+                del response.headers["content-length"]
+            return response
+
+        return negotiated_endpoint
+
+
+RESPONSE_COMPRESSION_MIN_SIZE = int(os.getenv("RESPONSE_COMPRESSION_MIN_SIZE", "1024"))
+RESPONSE_COMPRESSION_THREAD_SIZE = 256 * 1024
+STREAMING_CONTENT_TYPES = ("text/event-stream", RESPONSE_CONTENT_TYPES["ndjson"])
+ETAG_ENCODING_SUFFIXES = ("-gzip", "-br")
+NOT_MODIFIED_HEADERS = ("etag", "cache-control", "vary", "content-location", "expires", "date")
+
+
+class ConditionalCompressionMiddleware:
+    # Strong ETags, If-None-Match and gzip/brotli live together because the ETag has to name the encoded
+    # representation, and a 304 should be decided before paying for compression. Only complete
+    # single-message bodies are handled; SSE, NDJSON and other streamed responses pass through.
+    def __init__(self, app, minimum_size: int = RESPONSE_COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        passthrough = False
+
+        async def buffered_send(message):
+            nonlocal start, passthrough
+            if passthrough:
+                await send(message)
+            elif message["type"] == "http.response.start":
+                start = {**message, "headers": list(message.get("headers", []))}
+                if Headers(raw=start["headers"]).get("content-type", "").startswith(STREAMING_CONTENT_TYPES):
+                    passthrough = True
+                    await send(start)
+            elif message["type"] == "http.response.body" and message.get("more_body", False):
+                passthrough = True
+                await send(start)
+                await send(message)
+            elif message["type"] == "http.response.body":
+                start, body = await self.process(scope, start, message.get("body", b""))
+                await send(start)
+                await send({"type": "http.response.body", "body": body})
+            else:
+                await send(message)
+
+        await self.app(scope, receive, buffered_send)
+
+    def choose_encoding(self, scope) -> Optional[str]:
+        for encoding in accepted_values(Headers(scope=scope).get("accept-encoding")):
+            if encoding == "br" and brotli is not None:
+                return "br"
+            if encoding in ("gzip", "*"):
+                return "gzip"
+        return None
+
+    def compress(self, body: bytes, encoding: str) -> bytes:
+        if encoding == "br":
+            return brotli.compress(body, quality=4)
+        return gzip.compress(body, compresslevel=6, mtime=0)
+
+    async def process(self, scope, start, body: bytes) -> Tuple[Dict[str, Any], bytes]:
+        headers = MutableHeaders(raw=start["headers"])
+        encoding = None
+        if len(body) >= self.minimum_size and "content-encoding" not in headers:
+            headers.add_vary_header("Accept-Encoding")
+            encoding = self.choose_encoding(scope)
+
+        if scope["method"] == "GET" and start["status"] == 200:
+            if "etag" not in headers:
+                headers["ETag"] = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+            etag = headers["etag"]
+            if encoding and not etag.startswith("W/") and etag.endswith('"'):
+                headers["ETag"] = f'{etag[:-1]}-{encoding}"'
+
+            if etag_matches(Headers(scope=scope).get("if-none-match"), etag):
+                kept = [(name, value) for name, value in start["headers"] if name.decode().lower() in NOT_MODIFIED_HEADERS]
+                return {**start, "status": 304, "headers": kept}, b""
+
+        if encoding is None:
+            return start, body
+
+        if len(body) > RESPONSE_COMPRESSION_THREAD_SIZE:
+            body = await asyncio.to_thread(self.compress, body, encoding)
+        else:
+            body = self.compress(body, encoding)
+        headers["Content-Encoding"] = encoding
+        headers["Content-Length"] = str(len(body))
+        return start, body
+
+
+# -------------------------------------------------------------- METRICS --------------------------------------------------------------
+METRICS_SERVER_TIMING = os.getenv("METRICS_SERVER_TIMING", "false").lower() in ("1", "true", "yes")
+# Set by server.py when it runs several workers; each writes its metrics there and /metrics merges them.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+FIRESTORE_OPERATIONS = ("reads", "writes", "deletes")
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Request latency by route", ["method", "route", "status"]
+)
+FIRESTORE_DOCUMENTS = Histogram(
+    "firestore_documents_per_request", "Firestore documents read, written or deleted per request",
+    ["route", "operation"], buckets=COUNT_BUCKETS
+)
+REFERENCE_RESOLUTION_DEPTH = Histogram(
+    "reference_resolution_depth", "Levels of document references resolved per call", buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10)
+)
+REFERENCE_RESOLUTION_FANOUT = Histogram(
+    "reference_resolution_fanout", "Documents fetched per reference resolution level", buckets=COUNT_BUCKETS
 )
+OPENAI_REQUEST_DURATION = Histogram(
+    "openai_request_duration_seconds", "OpenAI chat completion latency", ["model", "stream"],
+    buckets=(0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+)
+OPENAI_TOKENS = Counter("openai_tokens_total", "OpenAI tokens used", ["model", "type"])
+
+request_metrics = contextvars.ContextVar("request_metrics", default=None)
+firestore_call_active = contextvars.ContextVar("firestore_call_active", default=False)
+
+
+def record_firestore(operation: str, count: int = 1, duration: float = 0.0):
+    metrics = request_metrics.get()
+    if metrics is not None:
+        metrics[operation] += count
+        metrics["firestore"] += duration
+
+
+def _instrument_coroutine(method, operation: str, count=lambda result: 1):
+    # Only the outermost instrumented call counts, so DocumentReference.set going through a WriteBatch
+    # is recorded once.
+    @functools.wraps(method)
+    async def instrumented(*args, **kwargs):
+        if firestore_call_active.get():
+            return await method(*args, **kwargs)
+        token = firestore_call_active.set(True)
+        started = time.perf_counter()
+        try:
+            result = await method(*args, **kwargs)
+        finally:
+            firestore_call_active.reset(token)
+        record_firestore(operation, count(result), time.perf_counter() - started)
+        return result
+    return instrumented
+
+
+def _instrument_generator(method, operation: str):
+    @functools.wraps(method)
+    async def instrumented(*args, **kwargs):
+        if firestore_call_active.get():
+            async for item in method(*args, **kwargs):
+                yield item
+            return
+        started = time.perf_counter()
+        count = 0
+        try:
+            async for item in method(*args, **kwargs):
+                count += 1
+                yield item
+        finally:
+            record_firestore(operation, count, time.perf_counter() - started)
+    return instrumented
+
+
+def _instrument_staging(method, operation: str):
+    @functools.wraps(method)
+    def instrumented(*args, **kwargs):
+        if not firestore_call_active.get():
+            record_firestore(operation)
+        return method(*args, **kwargs)
+    return instrumented
+
+
+def instrument_firestore(firestore_client):
+    # Patches the classes behind the given client, so references, queries and batches created anywhere
+    # from it are counted against the current request.
+    document = firestore_client.document("metrics/probe")
+    query = firestore_client.collection("metrics").limit(1)
+    aggregation_reads = lambda result: max(1, -(-int(result[0][0].value) // 1000))
+    targets = [
+        (type(firestore_client), "get_all", _instrument_generator, ("reads",)),
+        (type(query), "stream", _instrument_generator, ("reads",)),
+        (type(query.count()), "get", _instrument_coroutine, ("reads", aggregation_reads)),
+        (type(document), "get", _instrument_coroutine, ("reads",)),
+        (type(document), "create", _instrument_coroutine, ("writes",)),
+        (type(document), "set", _instrument_coroutine, ("writes",)),
+        (type(document), "update", _instrument_coroutine, ("writes",)),
+        (type(document), "delete", _instrument_coroutine, ("deletes",)),
+        (type(firestore_client.collection("metrics")), "add", _instrument_coroutine, ("writes",)),
+    ]
+    for batch in (firestore_client.batch(), firestore_client.transaction()):
+        targets += [
+            (type(batch), "create", _instrument_staging, ("writes",)),
+            (type(batch), "set", _instrument_staging, ("writes",)),
+            (type(batch), "update", _instrument_staging, ("writes",)),
+            (type(batch), "delete", _instrument_staging, ("deletes",)),
+        ]
+
+    for cls, name, instrument, arguments in targets:
+        method = getattr(cls, name)
+        if not getattr(method, "instrumented", False):
+            instrumented = instrument(method, *arguments)
+            instrumented.instrumented = True
+            setattr(cls, name, instrumented)
+
+
+def record_openai_usage(model: str, usage):
+    if usage is not None:
+        OPENAI_TOKENS.labels(model, "prompt").inc(usage.prompt_tokens or 0)
+        OPENAI_TOKENS.labels(model, "completion").inc(usage.completion_tokens or 0)
+
+
+def record_openai_duration(model: str, stream: bool, duration: float):
+    OPENAI_REQUEST_DURATION.labels(model, str(stream).lower()).observe(duration)
+    metrics = request_metrics.get()
+    if metrics is not None:
+        metrics["openai"] += duration
+
+
+async def _instrumented_openai_stream(stream, model: str, started: float):
+    try:
+        async for chunk in stream:
+            record_openai_usage(model, getattr(chunk, "usage", None))
+            yield chunk
+    finally:
+        record_openai_duration(model, True, time.perf_counter() - started)
+
+
+def instrument_openai(openai_client):
+    create = openai_client.chat.completions.create
+    if getattr(create, "instrumented", False):
+        return
+
+    @functools.wraps(create)
+    async def instrumented_create(*args, **kwargs):
+        model = kwargs.get("model", "unknown")
+        started = time.perf_counter()
+        response = await create(*args, **kwargs)
+        if kwargs.get("stream"):
+            return _instrumented_openai_stream(response, model, started)
+        record_openai_duration(model, False, time.perf_counter() - started)
+        record_openai_usage(model, getattr(response, "usage", None))
+        return response
+
+    instrumented_create.instrumented = True
+    openai_client.chat.completions.create = instrumented_create
+
+
+def server_timing(metrics: Dict[str, Any], duration: float) -> str:
+    counts = " ".join(f"{operation}={metrics[operation]}" for operation in FIRESTORE_OPERATIONS)
+    return (
+        f'app;dur={duration * 1000:.1f}, '
+        f'firestore;dur={metrics["firestore"] * 1000:.1f};desc="{counts}", '
+        f'openai;dur={metrics["openai"] * 1000:.1f}'
+    )
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        metrics = {"reads": 0, "writes": 0, "deletes": 0, "firestore": 0.0, "openai": 0.0}
+        token = request_metrics.set(metrics)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_metrics(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if METRICS_SERVER_TIMING:
+                    MutableHeaders(scope=message).append("Server-Timing", server_timing(metrics, time.perf_counter() - started))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            request_metrics.reset(token)
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_REQUEST_DURATION.labels(scope["method"], route, str(status)).observe(time.perf_counter() - started)
+            for operation in FIRESTORE_OPERATIONS:
+                FIRESTORE_DOCUMENTS.labels(route, operation).observe(metrics[operation])
+
+
+# -------------------------------------------------------------- LIFESPAN --------------------------------------------------------------
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "30"))
+WARMUP_RETRY_INTERVAL = float(os.getenv("WARMUP_RETRY_INTERVAL", "10"))
 
+warmup_checks: Dict[str, str] = {}
+warmup_retries: List[asyncio.Task] = []
 
-db = firestore.Client()
 
-app = FastAPI()
+async def warm_up_storage():
+    await repository.connect()
+    if not DOCUMENT_CACHE_LISTENERS:
+        await warm_document_cache()
+
+
+async def warm_up_openai():
+    await client.models.retrieve(CHAT_MODEL)
+
+
+async def warm_up(name: str, warmup) -> bool:
+    # Warm-up spares the first requests connection setup and cache misses. A failed step does not keep
+    # the app from starting, but /health/ready reports 503 until a background retry succeeds.
+    try:
+        await asyncio.wait_for(warmup(), WARMUP_TIMEOUT)
+        warmup_checks[name] = "ok"
+        return True
+    except Exception as e:
+        warmup_checks[name] = "failed"
+        print(f"Warm-up of {name} failed: {e!r}")
+        return False
+
+
+async def retry_warm_up(name: str, warmup):
+    while True:
+        await asyncio.sleep(WARMUP_RETRY_INTERVAL)
+        if await warm_up(name, warmup):
+            return
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global client, repository, analytics_repository
+    owned_repository = repository is None
+    owned_client = client is None
+    try:
+        if owned_client:
+            client = create_openai_client()
+        if owned_repository:
+            repository = create_storage_repository()
+        instrument_firestore(repository.client)
+        instrument_openai(client)
+
+        maps_data_store.start()
+        warmups = {"storage": warm_up_storage, "openai": warm_up_openai}
+        results = await asyncio.gather(*(warm_up(name, warmup) for name, warmup in warmups.items()))
+        for (name, warmup), ok in zip(warmups.items(), results):
+            if not ok:
+                warmup_retries.append(asyncio.create_task(retry_warm_up(name, warmup)))
+        await start_document_cache_listeners()
+        yield
+    finally:
+        for task in warmup_retries:
+            task.cancel()
+        await asyncio.gather(*warmup_retries, return_exceptions=True)
+        warmup_retries.clear()
+        warmup_checks.clear()
+        await stop_document_cache_listeners()
+        maps_data_store.stop()
+        if owned_client and client is not None:
+            await client.close()
+            client = None
+        if analytics_repository is not None and ANALYTICS_STORAGE_BACKEND != STORAGE_BACKEND:
+            await analytics_repository.close()
+        analytics_repository = None
+        if owned_repository and repository is not None:
+            await repository.close()
+            repository = None
+
+
+app = FastAPI(lifespan=lifespan)
+app.router.route_class = NegotiatedRoute
 
 origins = [
     '*'
@@ -37,56 +619,565 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(ConditionalCompressionMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+
+REFERENCE_MAX_DEPTH = int(os.getenv("REFERENCE_MAX_DEPTH", "10"))
+
+DOCUMENT_REFERENCE_TYPES = (firestore.AsyncDocumentReference, firestore.DocumentReference)
+
+DOCUMENT_CACHE_TTLS = {
+    "roles": 600,
+    "organizations": 300,
+    "departments": 300,
+}
+DOCUMENT_CACHE_MAX_ENTRIES = int(os.getenv("DOCUMENT_CACHE_MAX_ENTRIES", "10000"))
+DOCUMENT_CACHE_LISTENERS = os.getenv("DOCUMENT_CACHE_LISTENERS", "false").lower() in ("1", "true", "yes")
+
+
+class DocumentCache:
+    def __init__(self, ttls: Dict[str, float], max_entries: int):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _collection(self, key: str) -> str:
+        parts = key.split("/")
+        return parts[-2] if len(parts) % 2 == 0 else parts[-1]
+
+    def cacheable(self, key: str) -> bool:
+        return self._collection(key) in self.ttls
+
+    def _get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def _put(self, key: str, value, ttl: Optional[float] = None):
+        if ttl is None:
+            ttl = self.ttls[self._collection(key)]
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get(self, path: str) -> Optional[Dict[str, Any]]:
+        if not self.cacheable(path):
+            return None
+        data = self._get(path)
+        return dict(data) if data is not None else None
+
+    def put(self, path: str, data: Dict[str, Any], ttl: Optional[float] = None):
+        if self.cacheable(path):
+            self._put(path, data, ttl)
+
+    def get_collection(self, collection: str) -> Optional[List[Tuple[str, Dict[str, Any]]]]:
+        if not self.cacheable(collection):
+            return None
+        return self._get(collection)
+
+    def put_collection(self, collection: str, documents: List[Tuple[str, Dict[str, Any]]], ttl: Optional[float] = None):
+        if not self.cacheable(collection):
+            return
+        self._put(collection, documents, ttl)
+        for doc_id, data in documents:
+            self._put(f"{collection}/{doc_id}", data, ttl)
+
+    def invalidate(self, path: str):
+        with self._lock:
+            self._entries.pop(path, None)
+            self._entries.pop(path.rsplit("/", 1)[0], None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
 
 
-async def resolve_document_reference(ref: firestore.DocumentReference, resolved_refs: set = None) -> Dict[str, Any]:
-    if resolved_refs is None:
-        resolved_refs = set()
+document_cache = DocumentCache(DOCUMENT_CACHE_TTLS, DOCUMENT_CACHE_MAX_ENTRIES)
 
-    if str(ref.path) in resolved_refs:
-        return {"id": ref.id, "path": str(ref.path), "error": "Circular reference detected"}
 
-    resolved_refs.add(str(ref.path))
+async def fetch_documents(refs: List[firestore.AsyncDocumentReference]) -> Dict[str, Optional[Dict[str, Any]]]:
+    documents = {}
+    pending = {}
+    for ref in refs:
+        data = document_cache.get(ref.path)
+        if data is not None:
+            documents[ref.path] = data
+        else:
+            pending[ref.path] = ref
 
-    try:
-        doc = ref.get()
-        if doc.exists:
-            doc_data = doc.to_dict()
-            resolved_doc = {}
-            for key, value in doc_data.items():
-                if isinstance(value, firestore.DocumentReference):
-                    resolved_doc[key] = await resolve_document_reference(value, resolved_refs)
-                elif isinstance(value, list):
-                    resolved_list = []
-                    for item in value:
-                        if isinstance(item, firestore.DocumentReference):
-                            resolved_list.append(await resolve_document_reference(item, resolved_refs))
-                        else:
-                            resolved_list.append(item)
-                    resolved_doc[key] = resolved_list
-                else:
-                    resolved_doc[key] = value
+    if pending:
+        for snapshot in await repository.get_all(list(pending.values())):
+            data = snapshot.to_dict() if snapshot.exists else None
+            documents[snapshot.reference.path] = data
+            if data is not None:
+                document_cache.put(snapshot.reference.path, data)
 
-            return {"id": doc.id, **resolved_doc}
-        else:
-            return {"error": "Document not found", "path": str(ref.path)}
-    except Exception as e:
-        return {"error": str(e), "path": str(ref.path)}
+    return documents
+
+
+FIRESTORE_BATCH_LIMIT = 500
+
+
+async def stream_documents(query) -> List[firestore.DocumentSnapshot]:
+    return [doc async for doc in query.stream()]
+
+
+async def commit_in_batches(operations: List[Tuple[str, firestore.AsyncDocumentReference, Optional[Dict[str, Any]]]],
+                            every_batch: Optional[List[Tuple[str, firestore.AsyncDocumentReference, Optional[Dict[str, Any]]]]] = None):
+    # Each chunk is one atomic WriteBatch; Firestore accepts at most 500 writes per commit. Operations in
+    # every_batch are added to each chunk, so an update of a missing document fails every chunk.
+    every_batch = every_batch or []
+    size = FIRESTORE_BATCH_LIMIT - len(every_batch)
+    batches = []
+    for start in range(0, len(operations), size):
+        batch = repository.batch()
+        for operation, ref, data in operations[start:start + size] + every_batch:
+            if operation == "delete":
+                batch.delete(ref)
+            elif operation == "update":
+                batch.update(ref, data)
+            elif operation == "create":
+                batch.create(ref, data)
+            else:
+                batch.set(ref, data, merge=True)
+        batches.append(batch)
+    await asyncio.gather(*(batch.commit() for batch in batches))
+
+
+def _reference_slots(data: Dict[str, Any], ancestors: frozenset) -> List[tuple]:
+    slots = []
+    for key, value in data.items():
+        if isinstance(value, DOCUMENT_REFERENCE_TYPES):
+            slots.append((data, key, value, ancestors))
+        elif isinstance(value, list):
+            for index, item in enumerate(value):
+                if isinstance(item, DOCUMENT_REFERENCE_TYPES):
+                    slots.append((value, index, item, ancestors))
+    return slots
+
+
+async def resolve_document_references(items: List[Dict[str, Any]], max_depth: int = REFERENCE_MAX_DEPTH) -> List[Dict[str, Any]]:
+    # Resolves every DocumentReference in items in place, one level at a time, with a single
+    # get_all() per level. Documents are read at most once per call.
+    documents = {}
+    slots = []
+    for item in items:
+        for key, value in item.items():
+            if isinstance(value, list):
+                item[key] = list(value)
+        slots.extend(_reference_slots(item, frozenset()))
+
+    depth = 0
+    while slots:
+        depth += 1
+        if depth > max_depth:
+            for container, key, ref, _ in slots:
+                container[key] = {"id": ref.id, "path": ref.path}
+            break
+
+        pending = {}
+        for _, _, ref, ancestors in slots:
+            if ref.path not in documents and ref.path not in ancestors:
+                pending[ref.path] = ref
+
+        errors = {}
+        if pending:
+            REFERENCE_RESOLUTION_FANOUT.observe(len(pending))
+            try:
+                documents.update(await fetch_documents(list(pending.values())))
+            except Exception as e:
+                errors = {path: str(e) for path in pending}
+
+        next_slots = []
+        for container, key, ref, ancestors in slots:
+            path = ref.path
+            if path in ancestors:
+                container[key] = {"id": ref.id, "path": path, "error": "Circular reference detected"}
+            elif path in errors:
+                container[key] = {"error": errors[path], "path": path}
+            elif documents.get(path) is None:
+                container[key] = {"error": "Document not found", "path": path}
+            else:
+                resolved_doc = {"id": ref.id}
+                for field, value in documents[path].items():
+                    resolved_doc[field] = list(value) if isinstance(value, list) else value
+                container[key] = resolved_doc
+                next_slots.extend(_reference_slots(resolved_doc, ancestors | {path}))
+        slots = next_slots
+
+    REFERENCE_RESOLUTION_DEPTH.observe(min(depth, max_depth))
+    return items
 
 
 def make_serializable(data: Dict[str, Any]) -> Dict[str, Any]:
     serializable_data = {}
     for key, value in data.items():
-        if isinstance(value, firestore.DocumentReference):
+        if isinstance(value, DOCUMENT_REFERENCE_TYPES):
             serializable_data[key] = value
-        elif isinstance(value, (list, dict, str, int, float, type(None))):
+        elif isinstance(value, (list, dict, str, int, float, type(None), datetime.datetime, firestore.GeoPoint)):
             serializable_data[key] = value
         else:
             serializable_data[key] = str(value)
     return serializable_data
 
 
+def encode_cursor(values: Dict[str, Any]) -> str:
+    payload = {}
+    for key, value in values.items():
+        if isinstance(value, datetime.datetime):
+            payload[key] = {"datetime": value.isoformat()}
+        else:
+            payload[key] = value
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Dict[str, Any]:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        values = {}
+        for key, value in payload.items():
+            if isinstance(value, dict) and "datetime" in value:
+                values[key] = datetime.datetime.fromisoformat(value["datetime"])
+            else:
+                values[key] = value
+        return values
+    except (ValueError, TypeError, AttributeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        candidate = candidate.removeprefix("W/")
+        for suffix in ETAG_ENCODING_SUFFIXES:
+            if candidate.endswith(f'{suffix}"'):
+                candidate = f'{candidate[:-len(suffix) - 1]}"'
+        if candidate == etag:
+            return True
+    return False
+
+
+def parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    if fields is None:
+        return None
+    return [field.strip() for field in fields.split(",") if field.strip()]
+
+
+# -------------------------------------------------------------- CACHE --------------------------------------------------------------
+analytics_repository = None
+document_cache_watches = []
+
+
+def get_analytics_repository():
+    # maps_data can be loaded from a local SQLite replica (see storage.py) while everything else stays
+    # on Firestore, so analytics nodes start without reading the whole collection from Firestore.
+    global analytics_repository
+    if analytics_repository is None:
+        if ANALYTICS_STORAGE_BACKEND == STORAGE_BACKEND:
+            analytics_repository = repository.listener()
+        elif ANALYTICS_STORAGE_BACKEND == "sqlite":
+            analytics_repository = StorageRepository(SQLiteClient(SQLITE_STORAGE_PATH))
+        else:
+            analytics_repository = FirestoreRepository([firestore.Client()])
+    return analytics_repository
+
+
+def _to_async_references(data: Dict[str, Any]) -> Dict[str, Any]:
+    converted = {}
+    for key, value in data.items():
+        if isinstance(value, firestore.DocumentReference):
+            converted[key] = repository.reference(value.path)
+        elif isinstance(value, list):
+            converted[key] = [repository.reference(item.path) if isinstance(item, firestore.DocumentReference) else item for item in value]
+        else:
+            converted[key] = value
+    return converted
+
+
+def _document_cache_listener(collection: str):
+    # Entries fed by a listener never expire on their own; the listener keeps them current.
+    def on_snapshot(docs, changes, read_time):
+        for change in changes:
+            path = change.document.reference.path
+            if change.type.name == "REMOVED":
+                document_cache.invalidate(path)
+            else:
+                document_cache.put(path, _to_async_references(change.document.to_dict()), ttl=float("inf"))
+        document_cache.put_collection(
+            collection,
+            [(doc.id, _to_async_references(doc.to_dict())) for doc in docs],
+            ttl=float("inf"),
+        )
+
+    return on_snapshot
+
+
+async def warm_document_cache():
+    # Loads the cached collections whole, the way /get-roles caches roles. Collections too large for their
+    # share of the cache are left to fill on demand.
+    limit = DOCUMENT_CACHE_MAX_ENTRIES // len(DOCUMENT_CACHE_TTLS) - 1
+    snapshots = await asyncio.gather(*(
+        stream_documents(repository.collection(collection).limit(limit + 1)) for collection in DOCUMENT_CACHE_TTLS
+    ))
+    for collection, docs in zip(DOCUMENT_CACHE_TTLS, snapshots):
+        if len(docs) <= limit:
+            document_cache.put_collection(collection, [(doc.id, doc.to_dict()) for doc in docs])
+
+
+async def start_document_cache_listeners():
+    if not DOCUMENT_CACHE_LISTENERS:
+        return
+    listener = repository.listener()
+    for collection in DOCUMENT_CACHE_TTLS:
+        document_cache_watches.append(
+            listener.collection(collection).on_snapshot(_document_cache_listener(collection))
+        )
+
+
+async def stop_document_cache_listeners():
+    while document_cache_watches:
+        document_cache_watches.pop().unsubscribe()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/health/live")
+async def get_liveness():
+    return {"status": "ok"}
+
+
+@app.get("/health/ready")
+async def get_readiness(response: Response):
+    # Ready once every startup warm-up step has succeeded and the maps_data store holds its initial load.
+    checks = {**warmup_checks, "maps_data": "ok" if maps_data_store.ready.is_set() else "loading"}
+    ready = bool(warmup_checks) and all(status == "ok" for status in checks.values())
+    if not ready:
+        response.status_code = 503
+    return {"status": "ready" if ready else "starting", "checks": checks}
+
+
+@app.get("/cache-stats")
+async def get_cache_stats():
+    return {
+        "document_cache": document_cache.stats(),
+        "answer_cache": await asyncio.to_thread(answer_cache.stats),
+        "subscriptions": subscription_hub.stats(),
+    }
+
+
 # -------------------------------------------------------------- CHATBOT --------------------------------------------------------------
+CHAT_MODEL = "gpt-3.5-turbo"
+CHAT_PROMPT_VERSION = "1"
+CHAT_SYSTEM_PROMPT = (
+    "You are a useful assistant. Based on the user's input, "
+    "generate an array of 5 JSON objects. Each object should represent "
+    "a different workflow or approach to achieve the user's request. "
+    "Each object should include: 'name' (a brief name of the workflow), "
+    "'description' (a short explanation), and 'steps' (an array of 3-5 steps "
+    "to execute the workflow). Structure the response as valid JSON and nothing else. "
+)
+
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "answer_cache.sqlite3")
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "5000"))
+# A hit only rewrites last_used when the stored value is older than this, so most hits are read-only.
+ANSWER_CACHE_TOUCH_INTERVAL = 60
+
+
+class AnswerCache:
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._connection = None
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                "key TEXT PRIMARY KEY, answer TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS answers_last_used ON answers (last_used)")
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def key(self, message: str) -> str:
+        normalized = " ".join(message.split()).casefold()
+        return hashlib.sha256(f"{CHAT_MODEL}\0{CHAT_PROMPT_VERSION}\0{normalized}".encode()).hexdigest()
+
+    def _get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute("SELECT answer, last_used FROM answers WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[1] < now - ANSWER_CACHE_TOUCH_INTERVAL:
+                connection.execute("UPDATE answers SET last_used = ? WHERE key = ?", (now, key))
+                connection.commit()
+        return row[0] if row is not None else None
+
+    def _put(self, key: str, answer: str):
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO answers (key, answer, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, answer, now, now),
+            )
+            connection.execute(
+                "DELETE FROM answers WHERE key IN ("
+                "SELECT key FROM answers ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            connection.commit()
+
+    async def get(self, key: str) -> Optional[str]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def put(self, key: str, answer: str):
+        await asyncio.to_thread(self._put, key, answer)
+
+    async def lookup(self, key: str) -> Optional[str]:
+        # Identical questions that arrive while an upstream call is running wait for that call.
+        answer = await self.get(key)
+        if answer is not None:
+            self.hits += 1
+            return answer
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task)
+
+        self.misses += 1
+        return None
+
+    async def get_or_create(self, message: str, create) -> str:
+        key = self.key(message)
+        answer = await self.lookup(key)
+        if answer is not None:
+            return answer
+
+        task = asyncio.ensure_future(self._create(key, create))
+        self._register(key, task)
+        return await asyncio.shield(task)
+
+    def begin(self, key: str) -> asyncio.Future:
+        # For callers that produce the answer themselves (streaming): they resolve the future when done.
+        future = asyncio.get_running_loop().create_future()
+        self._register(key, future)
+        return future
+
+    def _register(self, key: str, future: asyncio.Future):
+        self._inflight[key] = future
+        future.add_done_callback(lambda done: self._forget(key, done))
+
+    def _forget(self, key: str, future: asyncio.Future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        # Failures reach whoever awaits the future; mark them retrieved when nobody was waiting.
+        if not future.cancelled():
+            future.exception()
+
+    async def _create(self, key: str, create) -> str:
+        answer = await create()
+        if is_complete_answer(answer):
+            await self.put(key, answer)
+        return answer
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = self._connect().execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._inflight),
+            "hit_ratio": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+        }
+
+
+answer_cache = AnswerCache(ANSWER_CACHE_PATH, ANSWER_CACHE_MAX_ENTRIES)
+
+
+def is_complete_answer(answer: Optional[str]) -> bool:
+    # Only answers in the shape CHAT_SYSTEM_PROMPT asks for are cached; a truncated answer is not valid JSON.
+    if not answer or not answer.strip():
+        return False
+    try:
+        json.loads(answer)
+    except ValueError:
+        return False
+    return True
+
+
+def chat_messages(message: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": CHAT_SYSTEM_PROMPT},
+        {"role": "user", "content": message}
+    ]
+
+
+async def generate_chat_answer(message: str) -> str:
+    response = await client.chat.completions.create(
+        model=CHAT_MODEL,
+        messages=chat_messages(message),
+        temperature=0,
+    )
+    return response.choices[0].message.content
+
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
 @app.post("/get-answer-to-chat")
 async def get_answer_to_chat(user_question: dict = Body(...)):
     message = user_question.get("message")
@@ -94,124 +1185,165 @@ async def get_answer_to_chat(user_question: dict = Body(...)):
     if not message or not user_id:
         raise HTTPException(status_code=400, detail="Both 'message' and 'user_id' are required.")
 
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {
-                "role": "system",
-                "content": (
-                    "You are a useful assistant. Based on the user's input, "
-                    "generate an array of 5 JSON objects. Each object should represent "
-                    "a different workflow or approach to achieve the user's request. "
-                    "Each object should include: 'name' (a brief name of the workflow), "
-                    "'description' (a short explanation), and 'steps' (an array of 3-5 steps "
-                    "to execute the workflow). Structure the response as valid JSON and nothing else. "
-                )
-            },
-            {"role": "user", "content": message}
-        ],
-        temperature=0,
-    )
+    answer_json = await answer_cache.get_or_create(message, lambda: generate_chat_answer(message))
 
-    answer_json = response.choices[0].message.content
+    await repository.add_message(user_id, message, answer_json)
+    return {"message": answer_json}
 
-    user_ref = db.collection("users").document(user_id)
+@app.post("/get-answer-to-chat/stream")
+async def stream_answer_to_chat(user_question: dict = Body(...)):
+    message = user_question.get("message")
+    user_id = user_question.get("user_id")
+    if not message or not user_id:
+        raise HTTPException(status_code=400, detail="Both 'message' and 'user_id' are required.")
+
+    async def events():
+        key = answer_cache.key(message)
+        try:
+            answer_json = await answer_cache.lookup(key)
+            if answer_json is not None:
+                yield sse_event("token", {"content": answer_json})
+            else:
+                # Identical questions arriving meanwhile wait on this future instead of starting their own stream.
+                answer_future = answer_cache.begin(key)
+                try:
+                    parts = []
+                    finish_reason = None
+                    stream = await client.chat.completions.create(
+                        model=CHAT_MODEL,
+                        messages=chat_messages(message),
+                        temperature=0,
+                        stream=True,
+                        stream_options={"include_usage": True},
+                    )
+                    async for chunk in stream:
+                        if not chunk.choices:
+                            continue
+                        finish_reason = chunk.choices[0].finish_reason or finish_reason
+                        if chunk.choices[0].delta.content:
+                            parts.append(chunk.choices[0].delta.content)
+                            yield sse_event("token", {"content": chunk.choices[0].delta.content})
+                    answer_json = "".join(parts)
+                    if finish_reason == "stop" and is_complete_answer(answer_json):
+                        await answer_cache.put(key, answer_json)
+                    answer_future.set_result(answer_json)
+                finally:
+                    # Covers upstream errors and clients disconnecting mid-stream.
+                    if not answer_future.done():
+                        answer_future.set_exception(RuntimeError("Answer stream ended before completing"))
+
+            await repository.add_message(user_id, message, answer_json)
+            yield sse_event("done", {"message": answer_json})
+        except Exception as e:
+            yield sse_event("error", {"detail": f"Error generating answer: {e}"})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+USER_MESSAGES_MAX_PAGE_SIZE = 100
 
-    db.collection("ia_answers").add({
-        "ia_answer": answer_json,
-        "user": user_ref,
-        "user_message": message
-    })
-    return {"message": answer_json}
 
 @app.get("/get-user-messages")
-async def get_user_messages(user_id: str):
-    user_ref = db.collection("users").document(user_id)
-    collection_ref = db.collection("ia_answers").where("user", "==", user_ref)
-    docs = collection_ref.stream()
+async def get_user_messages(user_id: str, limit: int = 20, cursor: Optional[str] = None, fields: Optional[str] = None):
+    if not 1 <= limit <= USER_MESSAGES_MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {USER_MESSAGES_MAX_PAGE_SIZE}")
+
+    user_ref = repository.user(user_id)
+    collection_ref = repository.messages_by_user(user_id)
+
+    selected_fields = parse_fields(fields)
+    if selected_fields is not None:
+        collection_ref = collection_ref.select(sorted(set(selected_fields) | {"created_at"}))
+    if cursor:
+        collection_ref = collection_ref.start_after(decode_cursor(cursor))
+
+    docs = await stream_documents(collection_ref.limit(limit + 1))
+
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = encode_cursor({"created_at": docs[-1].get("created_at"), "__name__": docs[-1].id})
 
     data = []
     for doc in docs:
         raw_data = doc.to_dict()
+        if selected_fields is not None and "created_at" not in selected_fields:
+            raw_data.pop("created_at", None)
         serializable_data = make_serializable(raw_data)
+        data.append({"id": doc.id, **serializable_data})
 
-        resolved_data = {}
-        for key, value in serializable_data.items():
-            if isinstance(value, firestore.DocumentReference):
-                resolved_data[key] = await resolve_document_reference(value)
-            else:
-                resolved_data[key] = value
-
-        data.append({"id": doc.id, **resolved_data})
-
-        print(data)
+    if data and (selected_fields is None or "user" in selected_fields):
+        resolved_user = (await resolve_document_references([{"user": user_ref}]))[0]["user"]
+        for item in data:
+            item["user"] = resolved_user
 
-    if not data:
+    if not data and not cursor:
         raise HTTPException(status_code=404, detail="No data found for the specified user")
 
-    return {"user_messages": data[0]}
+    return {"user_messages": data, "next_cursor": next_cursor}
 
 # -------------------------------------------------------------- ORGANIZATION CRUD --------------------------------------------------------------
-@app.get("/get-organization-info")
-async def get_organization_info(organization_id: str):
-    organization_ref = db.collection("organizations").document(organization_id)
+ORGANIZATION_SECTIONS = ("departments", "users")
 
-    org_doc = organization_ref.get()
-
-    if not org_doc.exists:
-        raise HTTPException(status_code=404, detail="Organization not found")
 
-    org_data = org_doc.to_dict()
-    serializable_org_data = make_serializable(org_data)
+@app.get("/get-organization-info")
+async def get_organization_info(organization_id: str, include: Optional[str] = None, depth: Optional[int] = None):
+    sections = parse_fields(include) if include is not None else list(ORGANIZATION_SECTIONS)
+    unknown_sections = set(sections) - set(ORGANIZATION_SECTIONS)
+    if unknown_sections:
+        raise HTTPException(status_code=400, detail=f"Unknown sections: {', '.join(sorted(unknown_sections))}")
+
+    if depth is None:
+        depth = REFERENCE_MAX_DEPTH
+    if depth < 0:
+        raise HTTPException(status_code=400, detail="depth must be zero or positive")
+
+    organization_ref = repository.organization(organization_id)
+    departments_ref = repository.departments_by_organization(organization_id)
+    users_ref = repository.users_by_organization(organization_id)
+
+    async def read_section(section, query):
+        return await stream_documents(query) if section in sections else []
+
+    org_docs, departments_docs, users_docs = await asyncio.gather(
+        fetch_documents([organization_ref]),
+        read_section("departments", departments_ref),
+        read_section("users", users_ref),
+    )
 
-    resolved_org_data = {}
-    for key, value in serializable_org_data.items():
-        if isinstance(value, firestore.DocumentReference):
-            resolved_org_data[key] = await resolve_document_reference(value)
-        else:
-            resolved_org_data[key] = value
+    org_data = org_docs.get(organization_ref.path)
+    if org_data is None:
+        raise HTTPException(status_code=404, detail="Organization not found")
 
-    departments_ref = db.collection("departments").where("organization", "==", organization_ref)
-    departments_docs = departments_ref.stream()
+    resolved_org_data = make_serializable(org_data)
 
     departments_data = []
     for dept_doc in departments_docs:
         dept_dict = dept_doc.to_dict()
         serializable_dept_data = make_serializable(dept_dict)
-
-        resolved_dept_data = {}
-        for key, value in serializable_dept_data.items():
-            if isinstance(value, firestore.DocumentReference):
-                resolved_dept_data[key] = await resolve_document_reference(value)
-            else:
-                resolved_dept_data[key] = value
-
-        departments_data.append({"id": dept_doc.id, **resolved_dept_data})
-
-    users_ref = db.collection("users").where("organization", "==", organization_ref)
-    users_docs = users_ref.stream()
+        departments_data.append({"id": dept_doc.id, **serializable_dept_data})
 
     users_data = []
     for user_doc in users_docs:
         user_dict = user_doc.to_dict()
         serializable_user_data = make_serializable(user_dict)
+        users_data.append({"id": user_doc.id, **serializable_user_data})
 
-        resolved_user_data = {}
-        for key, value in serializable_user_data.items():
-            if isinstance(value, firestore.DocumentReference):
-                resolved_user_data[key] = await resolve_document_reference(value)
-            else:
-                resolved_user_data[key] = value
-
-        users_data.append({"id": user_doc.id, **resolved_user_data})
+    await resolve_document_references(
+        [resolved_org_data, *departments_data, *users_data],
+        max_depth=min(depth, REFERENCE_MAX_DEPTH),
+    )
 
-    response_data = {
-        "organization": {"id": organization_id, **resolved_org_data},
-        "departments": departments_data,
-        "users": users_data
-    }
+    response_data = {"organization": {"id": organization_id, **resolved_org_data}}
+    if "departments" in sections:
+        response_data["departments"] = departments_data
+    if "users" in sections:
+        response_data["users"] = users_data
 
-    if not departments_data and not users_data:
+    if sections and not departments_data and not users_data:
         raise HTTPException(status_code=404,
                             detail="No departments or users were found for the specified organization")
 
@@ -228,10 +1360,10 @@ async def create_user(user_data: dict = Body(...)):
         if not role_id:
             raise HTTPException(status_code=400, detail="role_id is required")
 
-        role_ref = db.collection("roles").document(role_id)
-        role_doc = role_ref.get()
+        role_ref = repository.role(role_id)
+        role_docs = await fetch_documents([role_ref])
 
-        if not role_doc.exists:
+        if role_docs.get(role_ref.path) is None:
             raise HTTPException(status_code=404, detail=f"Role with id {role_id} no found")
 
         user_data["role"] = role_ref
@@ -241,21 +1373,21 @@ async def create_user(user_data: dict = Body(...)):
         organization_name = user_data.get("organization_name")
         organization_ref = None
         if organization_name:
-            organization_ref = db.collection("organizations").document()
-            organization_ref.set({"name": organization_name})
+            organization_ref = repository.organization()
+            await organization_ref.set({"name": organization_name})
+            document_cache.invalidate(organization_ref.path)
 
             user_data["organization"] = organization_ref
 
             user_data.pop("organization_name", None)
 
-        collection_ref = db.collection("users")
-
-        doc_ref = collection_ref.add(user_data)
+        user_ref = await repository.add_user(user_data)
 
-        doc_id = doc_ref[1].id
+        doc_id = user_ref.id
 
         if organization_ref:
-            organization_ref.update({"admin_id": doc_ref[1]})
+            await organization_ref.update({"admin_id": user_ref})
+            document_cache.invalidate(organization_ref.path)
 
         return {"message": "User created successfully", "user_id": doc_id}
 
@@ -264,22 +1396,16 @@ async def create_user(user_data: dict = Body(...)):
 
 @app.get("/get-user-info")
 async def get_user_info(user_id: str):
-    collection_ref = db.collection("users").where("user_id", "==", user_id)
+    collection_ref = repository.users_by_user_id(user_id)
     docs = collection_ref.stream()
 
     data = []
-    for doc in docs:
+    async for doc in docs:
         raw_data = doc.to_dict()
         serializable_data = make_serializable(raw_data)
+        data.append({"id": doc.id, **serializable_data})
 
-        resolved_data = {}
-        for key, value in serializable_data.items():
-            if isinstance(value, firestore.DocumentReference):
-                resolved_data[key] = await resolve_document_reference(value)
-            else:
-                resolved_data[key] = value
-
-        data.append({"id": doc.id, **resolved_data})
+    await resolve_document_references(data)
 
     if not data:
         raise HTTPException(status_code=404, detail="No data found for the specified user")
@@ -288,19 +1414,18 @@ async def get_user_info(user_id: str):
 
 @app.get("/get-roles")
 async def get_roles():
-    collection_ref = db.collection("roles")
-    docs = collection_ref.stream()
+    roles = document_cache.get_collection("roles")
+    if roles is None:
+        collection_ref = repository.roles()
+        roles = [(doc.id, doc.to_dict()) async for doc in collection_ref.stream()]
+        document_cache.put_collection("roles", roles)
 
     data = []
-    for doc in docs:
-        raw_data = doc.to_dict()
+    for role_id, raw_data in roles:
         serializable_data = make_serializable(raw_data)
+        data.append({"id": role_id, **serializable_data})
 
-        for key, value in serializable_data.items():
-            if isinstance(value, firestore.DocumentReference):
-                serializable_data[key] = await resolve_document_reference(value)
-
-        data.append({"id": doc.id, **serializable_data})
+    await resolve_document_references(data)
 
     if not data:
         raise HTTPException(status_code=404, detail="No data found for the specified user")
@@ -309,27 +1434,209 @@ async def get_roles():
 
 
 # -------------------------------------------------------------- TASKS CRUD --------------------------------------------------------------
+# Bulk creation is one transaction, which holds at most FIRESTORE_BATCH_LIMIT writes.
+TASKS_BULK_MAX = 500
+TASKS_MAX_PAGE_SIZE = 500
+TASK_SORT_FIELDS = ("title", "status")
+TASK_RESOLVE_MODES = ("none", "summary", "full")
+TASK_REFERENCES = ("assigned_to", "created_by", "department", "organization")
+TASK_STATUSES = [status.strip() for status in os.getenv("TASK_STATUSES", "todo,in_progress,done").split(",") if status.strip()]
+TASK_STATS_TTL = float(os.getenv("TASK_STATS_TTL", "30"))
+TASK_STATS_MAX_ENTRIES = int(os.getenv("TASK_STATS_MAX_ENTRIES", "1000"))
+
+
+class TaskStatsCache(DocumentCache):
+    # Same TTL and LRU bounds as the document cache, keyed by organization and the sorted statuses.
+    def __init__(self, ttl: float, max_entries: int):
+        super().__init__({}, max_entries)
+        self.ttl = ttl
+
+    def get_stats(self, organization_id: str, statuses: Tuple[str, ...]) -> Optional[Dict[str, Any]]:
+        return self._get((organization_id, tuple(sorted(statuses))))
+
+    def put_stats(self, organization_id: str, statuses: Tuple[str, ...], stats: Dict[str, Any]):
+        self._put((organization_id, tuple(sorted(statuses))), stats, self.ttl)
+
+    def invalidate_organizations(self, organization_ids):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] in organization_ids]:
+                del self._entries[key]
+
+
+task_stats_cache = TaskStatsCache(TASK_STATS_TTL, TASK_STATS_MAX_ENTRIES)
+
+
+def invalidate_task_stats(*organizations):
+    organization_ids = {
+        organization.id if isinstance(organization, DOCUMENT_REFERENCE_TYPES) else organization
+        for organization in organizations if organization is not None
+    }
+    task_stats_cache.invalidate_organizations(organization_ids)
+
+
+TASK_REQUIRED_FIELDS = ("assigned_to_id", "created_by_id", "department_id", "organization_id", "expected_outcome", "status", "title")
+TASK_REFERENCE_FIELDS = {
+    "assigned_to_id": "users",
+    "created_by_id": "users",
+    "department_id": "departments",
+    "organization_id": "organizations",
+}
+
+
+async def ensure_documents_exist(transaction, checks: List[Tuple[firestore.AsyncDocumentReference, str]]) -> Dict[str, Any]:
+    snapshots = await transaction.get_all([ref for ref, _ in checks])
+    for ref, detail in checks:
+        snapshot = snapshots.get(ref.path)
+        if snapshot is None or not snapshot.exists:
+            raise HTTPException(status_code=404, detail=detail)
+    return snapshots
+
+
+async def create_task_transaction(transaction, task_ref, task_data: Dict[str, Any], checks):
+    await ensure_documents_exist(transaction, checks)
+    transaction.create(task_ref, task_data)
+
+
+async def create_tasks_transaction(transaction, operations, checks):
+    await ensure_documents_exist(transaction, checks)
+    for _, task_ref, task_data in operations:
+        transaction.create(task_ref, task_data)
+
+
+async def update_task_transaction(transaction, task_ref, updated_fields: Dict[str, Any], checks):
+    snapshots = await ensure_documents_exist(transaction, checks)
+    transaction.update(task_ref, updated_fields)
+    return snapshots[task_ref.path].to_dict().get("organization")
+
+
+async def summarize_task_references(tasks: List[Dict[str, Any]]):
+    refs = {}
+    for task in tasks:
+        for field in TASK_REFERENCES:
+            if isinstance(task.get(field), DOCUMENT_REFERENCE_TYPES):
+                refs[task[field].path] = task[field]
+
+    documents = await fetch_documents(list(refs.values()))
+    for task in tasks:
+        for field in TASK_REFERENCES:
+            ref = task.get(field)
+            if not isinstance(ref, DOCUMENT_REFERENCE_TYPES):
+                continue
+            document = documents.get(ref.path)
+            if document is None:
+                task[field] = {"id": ref.id, "path": ref.path, "error": "Document not found"}
+            else:
+                task[field] = {"id": ref.id, "name": document.get("name")}
+
+
 @app.get("/get-tasks-by-organization")
-async def get_tasks_by_organization(organization_id: str):
-    collection_ref = db.collection("tasks").where("organization", "==", db.document(f"organizations/{organization_id}"))
-    docs = collection_ref.stream()
+async def get_tasks_by_organization(
+    organization_id: str,
+    status: Optional[str] = None,
+    assigned_to_id: Optional[str] = None,
+    department_id: Optional[str] = None,
+    created_by_id: Optional[str] = None,
+    sort: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    resolve: str = "full"
+):
+    if resolve not in TASK_RESOLVE_MODES:
+        raise HTTPException(status_code=400, detail=f"resolve must be one of {', '.join(TASK_RESOLVE_MODES)}")
+    if sort is not None and sort.lstrip("-") not in TASK_SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"sort must be one of {', '.join(TASK_SORT_FIELDS)}, optionally prefixed with '-'")
+    if limit is not None and not 1 <= limit <= TASKS_MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {TASKS_MAX_PAGE_SIZE}")
+
+    collection_ref = repository.tasks(
+        organization_id, status=status, assigned_to_id=assigned_to_id, department_id=department_id, created_by_id=created_by_id
+    )
+
+    sort_field = sort.lstrip("-") if sort else None
+    direction = firestore.Query.DESCENDING if sort and sort.startswith("-") else firestore.Query.ASCENDING
+    if sort_field:
+        collection_ref = collection_ref.order_by(sort_field, direction=direction)
+    if sort_field or limit is not None or cursor:
+        collection_ref = collection_ref.order_by("__name__", direction=direction)
+
+    selected_fields = parse_fields(fields)
+    if selected_fields is not None:
+        collection_ref = collection_ref.select(sorted(set(selected_fields) | ({sort_field} if sort_field else set())))
+    if cursor:
+        collection_ref = collection_ref.start_after(decode_cursor(cursor))
+    if limit is not None:
+        collection_ref = collection_ref.limit(limit + 1)
+
+    docs = await stream_documents(collection_ref)
+
+    next_cursor = None
+    if limit is not None and len(docs) > limit:
+        docs = docs[:limit]
+        last = docs[-1]
+        next_cursor = encode_cursor({**({sort_field: last.get(sort_field)} if sort_field else {}), "__name__": last.id})
 
     tasks = []
     for doc in docs:
         raw_data = doc.to_dict()
-        resolved_data = {}
-        for key, value in raw_data.items():
-            if isinstance(value, firestore.DocumentReference):
-                resolved_data[key] = await resolve_document_reference(value)
-            else:
-                resolved_data[key] = value
+        if selected_fields is not None and sort_field and sort_field not in selected_fields:
+            raw_data.pop(sort_field, None)
+        tasks.append({"id": doc.id, **raw_data})
 
-        tasks.append({"id": doc.id, **resolved_data})
+    if resolve == "full":
+        await resolve_document_references(tasks)
+    elif resolve == "summary":
+        await summarize_task_references(tasks)
 
-    if not tasks:
-        return {"tasks": []}
+    if limit is not None:
+        return {"tasks": tasks, "next_cursor": next_cursor}
 
     return {"tasks": tasks}
+
+
+async def count_documents(query) -> int:
+    result = await query.count(alias="count").get()
+    return int(result[0][0].value)
+
+
+@app.get("/get-task-stats")
+async def get_task_stats(organization_id: str, statuses: Optional[str] = None):
+    selected_statuses = tuple(dict.fromkeys(parse_fields(statuses) or TASK_STATUSES))
+    cached = task_stats_cache.get_stats(organization_id, selected_statuses)
+    if cached is not None:
+        return cached
+
+    departments = await stream_documents(repository.departments_by_organization(organization_id).select(["name"]))
+
+    # One count() aggregation per (department, status) bucket plus the totals, all issued at once;
+    # each costs one read per 1000 matching tasks instead of one read per task.
+    buckets = [(department, status) for department in (None, *departments) for status in (None, *selected_statuses)]
+    counts = await asyncio.gather(*(
+        count_documents(repository.tasks(organization_id, status=status, department_id=department.id if department else None))
+        for department, status in buckets
+    ))
+
+    totals = {}
+    for (department, status), count in zip(buckets, counts):
+        totals[(department.id if department else None, status)] = count
+
+    def summarize(department_id: Optional[str]) -> Dict[str, Any]:
+        by_status = {status: totals[(department_id, status)] for status in selected_statuses}
+        by_status["other"] = totals[(department_id, None)] - sum(by_status.values())
+        return {"total": totals[(department_id, None)], "by_status": by_status}
+
+    stats = {
+        "organization_id": organization_id,
+        **summarize(None),
+        "departments": [
+            {"id": department.id, "name": department.get("name"), **summarize(department.id)}
+            for department in departments
+        ],
+    }
+    task_stats_cache.put_stats(organization_id, selected_statuses, stats)
+    return stats
+
+
 @app.post("/create-task")
 async def create_task(task_data: dict = Body(...)):
     try:
@@ -344,22 +1651,17 @@ async def create_task(task_data: dict = Body(...)):
         if not all([assigned_to_id, created_by_id, department_id, organization_id, expected_outcome, status, title]):
             raise HTTPException(status_code=400, detail="All fields are required")
 
-        assigned_to_ref = db.collection("users").document(assigned_to_id)
-        created_by_ref = db.collection("users").document(created_by_id)
-        department_ref = db.collection("departments").document(department_id)
-        organization_ref = db.collection("organizations").document(organization_id)
-
-        if not assigned_to_ref.get().exists:
-            raise HTTPException(status_code=404, detail=f"User assigned with id {assigned_to_id} not found")
-
-        if not created_by_ref.get().exists:
-            raise HTTPException(status_code=404, detail=f"User assigned with id {created_by_id} not found")
+        assigned_to_ref = repository.user(assigned_to_id)
+        created_by_ref = repository.user(created_by_id)
+        department_ref = repository.department(department_id)
+        organization_ref = repository.organization(organization_id)
 
-        if not department_ref.get().exists:
-            raise HTTPException(status_code=404, detail=f"Department with id {department_id} not found")
-
-        if not organization_ref.get().exists:
-            raise HTTPException(status_code=404, detail=f"Organization with id {organization_id} not found")
+        checks = [
+            (assigned_to_ref, f"User assigned with id {assigned_to_id} not found"),
+            (created_by_ref, f"User assigned with id {created_by_id} not found"),
+            (department_ref, f"Department with id {department_id} not found"),
+            (organization_ref, f"Organization with id {organization_id} not found"),
+        ]
 
         task_data = {
             "assigned_to": assigned_to_ref,
@@ -371,43 +1673,87 @@ async def create_task(task_data: dict = Body(...)):
             "title": title,
         }
 
-        task_ref = db.collection("tasks").add(task_data)
+        task_ref = repository.task()
+        await repository.run_transaction(create_task_transaction, task_ref, task_data, checks)
+        invalidate_task_stats(organization_id)
 
-        return {"message": "Task created successfully", "task_id": task_ref[1].id}
+        return {"message": "Task created successfully", "task_id": task_ref.id}
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error creating task: {e}")
 
+@app.post("/create-tasks")
+async def create_tasks(payload: dict = Body(...)):
+    try:
+        tasks = payload.get("tasks")
+        if not isinstance(tasks, list) or not tasks:
+            raise HTTPException(status_code=400, detail="A non-empty list of tasks is required")
+
+        if len(tasks) > TASKS_BULK_MAX:
+            raise HTTPException(status_code=400, detail=f"At most {TASKS_BULK_MAX} tasks can be created at once")
+
+        for index, task in enumerate(tasks):
+            if not isinstance(task, dict) or not all(task.get(field) for field in TASK_REQUIRED_FIELDS):
+                raise HTTPException(status_code=400, detail=f"All fields are required (task {index})")
+
+        refs = {}
+        for task in tasks:
+            for field, collection in TASK_REFERENCE_FIELDS.items():
+                ref = repository.document(collection, task[field])
+                refs[ref.path] = ref
+
+        operations = []
+        for task in tasks:
+            task_ref = repository.task()
+            operations.append(("create", task_ref, {
+                "assigned_to": refs[f"users/{task['assigned_to_id']}"],
+                "created_by": refs[f"users/{task['created_by_id']}"],
+                "department": refs[f"departments/{task['department_id']}"],
+                "organization": refs[f"organizations/{task['organization_id']}"],
+                "expected_outcome": task["expected_outcome"],
+                "status": task["status"],
+                "title": task["title"],
+            }))
+
+        # Read uncached inside the transaction, so a reference deleted since it was cached is rejected and
+        # either every task is created or none is.
+        checks = [(ref, f"Referenced document not found: {path}") for path, ref in sorted(refs.items())]
+        await repository.run_transaction(create_tasks_transaction, operations, checks)
+        invalidate_task_stats(*(task["organization_id"] for task in tasks))
+        return {"message": "Tasks created successfully", "task_ids": [ref.id for _, ref, _ in operations]}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error creating tasks: {e}")
+
 @app.put("/update-task")
 async def update_task(task_id: str, task_data: dict = Body(...)):
     try:
-        task_ref = db.collection("tasks").document(task_id)
-        if not task_ref.get().exists:
-            raise HTTPException(status_code=404, detail=f"Task with id {task_id} not found")
+        task_ref = repository.task(task_id)
+        checks = [(task_ref, f"Task with id {task_id} not found")]
 
         updated_fields = {}
         if "assigned_to_id" in task_data:
-            assigned_to_ref = db.collection("users").document(task_data["assigned_to_id"])
-            if not assigned_to_ref.get().exists:
-                raise HTTPException(status_code=404, detail=f"User assigned with id {task_data['assigned_to_id']} not found")
+            assigned_to_ref = repository.user(task_data["assigned_to_id"])
+            checks.append((assigned_to_ref, f"User assigned with id {task_data['assigned_to_id']} not found"))
             updated_fields["assigned_to"] = assigned_to_ref
 
         if "created_by_id" in task_data:
-            created_by_ref = db.collection("users").document(task_data["created_by_id"])
-            if not created_by_ref.get().exists:
-                raise HTTPException(status_code=404, detail=f"User assigned with id {task_data['created_by_id']} not found")
+            created_by_ref = repository.user(task_data["created_by_id"])
+            checks.append((created_by_ref, f"User assigned with id {task_data['created_by_id']} not found"))
             updated_fields["created_by"] = created_by_ref
 
         if "department_id" in task_data:
-            department_ref = db.collection("departments").document(task_data["department_id"])
-            if not department_ref.get().exists:
-                raise HTTPException(status_code=404, detail=f"Department with id {task_data['department_id']} not found")
+            department_ref = repository.department(task_data["department_id"])
+            checks.append((department_ref, f"Department with id {task_data['department_id']} not found"))
             updated_fields["department"] = department_ref
 
         if "organization_id" in task_data:
-            organization_ref = db.collection("organizations").document(task_data["organization_id"])
-            if not organization_ref.get().exists:
-                raise HTTPException(status_code=404, detail=f"Organization with id {task_data['organization_id']} not found")
+            organization_ref = repository.organization(task_data["organization_id"])
+            checks.append((organization_ref, f"Organization with id {task_data['organization_id']} not found"))
             updated_fields["organization"] = organization_ref
 
         for field in ["expected_outcome", "title"]:
@@ -423,9 +1769,12 @@ async def update_task(task_id: str, task_data: dict = Body(...)):
         if not updated_fields:
             raise HTTPException(status_code=400, detail="No valid fields were provided to update")
 
-        task_ref.update(updated_fields)
+        previous_organization = await repository.run_transaction(update_task_transaction, task_ref, updated_fields, checks)
+        invalidate_task_stats(previous_organization, updated_fields.get("organization"))
         return {"message": "Task updated successfully", "task_id": task_id}
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error updating task: {e}")
 
@@ -433,11 +1782,13 @@ async def update_task(task_id: str, task_data: dict = Body(...)):
 @app.delete("/delete-task")
 async def delete_task(task_id: str):
     try:
-        task_ref = db.collection("tasks").document(task_id)
-        if not task_ref.get().exists:
+        task_ref = repository.task(task_id)
+        task_doc = await task_ref.get()
+        if not task_doc.exists:
             raise HTTPException(status_code=404, detail=f"Task with id {task_id} not found")
 
-        task_ref.delete()
+        await task_ref.delete()
+        invalidate_task_stats(task_doc.to_dict().get("organization"))
         return {"message": "Task deleted successfully", "task_id": task_id}
 
     except Exception as e:
@@ -456,66 +1807,108 @@ async def create_workflow(workflow_data: dict = Body(...)):
         if not all([created_by_id, title, organization_id]):
             raise HTTPException(status_code=400, detail="All fields are required")
 
-        created_by_ref = db.collection("users").document(created_by_id)
-        organization_ref = db.collection("organizations").document(organization_id)
+        created_by_ref = repository.user(created_by_id)
+        organization_ref = repository.organization(organization_id)
 
-        if not created_by_ref.get().exists:
+        documents = await fetch_documents([created_by_ref, organization_ref])
+
+        if documents.get(created_by_ref.path) is None:
             raise HTTPException(status_code=404, detail=f"Creator user with id {created_by_id} not found")
 
-        if not organization_ref.get().exists:
+        if documents.get(organization_ref.path) is None:
             raise HTTPException(status_code=404, detail=f"Organization with id {organization_id} not found")
 
         workflow_data = {
             "created_by": created_by_ref,
             "organization": organization_ref,
             "title": title,
-            "description": description
+            "description": description,
+            "graph_version": 0
         }
 
-        workflow_ref = db.collection("workflows").add(workflow_data)
+        workflow_ref = await repository.add_workflow(workflow_data)
 
-        return {"message": "Workflow created successfully", "workflow_id": workflow_ref[1].id}
+        return {"message": "Workflow created successfully", "workflow_id": workflow_ref.id}
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error creating workflow: {e}")
 
+
+async def delete_workflow_graph(workflow_ref: firestore.AsyncDocumentReference) -> Dict[str, int]:
+    # Nodes and edges go first so an interrupted delete can be retried from the workflow.
+    nodes, edges = await asyncio.gather(
+        stream_documents(repository.nodes_by_workflow(workflow_ref.id).select([])),
+        stream_documents(repository.edges_by_workflow(workflow_ref.id).select([])),
+    )
+    await commit_in_batches([("delete", doc.reference, None) for doc in nodes + edges])
+    await workflow_ref.delete()
+    return {"deleted_nodes": len(nodes), "deleted_edges": len(edges)}
+
+
+# Job state lives in storage so a status poll answered by any worker, or after a restart, sees it.
+async def run_workflow_delete_job(job_id: str, workflow_ref: firestore.AsyncDocumentReference):
+    job_ref = repository.workflow_delete_job(job_id)
+    await job_ref.update({"status": "running"})
+    try:
+        result = {**await delete_workflow_graph(workflow_ref), "status": "completed"}
+    except Exception as e:
+        result = {"status": "failed", "error": str(e)}
+    result["finished_at"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    await job_ref.update(result)
+
+
+async def register_workflow_delete_job(workflow_id: str) -> str:
+    job_id = uuid.uuid4().hex
+    await repository.workflow_delete_job(job_id).set({
+        "job_id": job_id,
+        "workflow_id": workflow_id,
+        "status": "pending",
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    })
+    return job_id
+
+
 @app.delete("/delete-workflow")
-async def delete_workflow(workflow_id: str):
+async def delete_workflow(workflow_id: str, response: Response, background_tasks: BackgroundTasks, background: bool = False):
     try:
-        workflow_ref = db.collection("workflows").document(workflow_id)
-        if not workflow_ref.get().exists:
+        workflow_ref = repository.workflow(workflow_id)
+        if not (await workflow_ref.get()).exists:
             raise HTTPException(status_code=404, detail=f"Workflow with id {workflow_id} not found")
 
-        nodes_query = db.collection("nodes").where("workflow", "==", workflow_ref).stream()
-        for node in nodes_query:
-            db.collection("nodes").document(node.id).delete()
+        if background:
+            job_id = await register_workflow_delete_job(workflow_id)
+            background_tasks.add_task(run_workflow_delete_job, job_id, workflow_ref)
+            response.status_code = 202
+            return {"message": "Workflow deletion started", "workflow_id": workflow_id, "job_id": job_id}
 
-        edges_query = db.collection("edges").where("workflow", "==", workflow_ref).stream()
-        for edge in edges_query:
-            db.collection("edges").document(edge.id).delete()
+        deleted = await delete_workflow_graph(workflow_ref)
 
-        workflow_ref.delete()
-
-        return {"message": "Workflow successfully deleted", "workflow_id": workflow_id}
+        return {"message": "Workflow successfully deleted", "workflow_id": workflow_id, **deleted}
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error deleting workflow: {e}")
+
+@app.get("/delete-workflow-status")
+async def get_delete_workflow_status(job_id: str):
+    job = await repository.workflow_delete_job(job_id).get()
+    if not job.exists:
+        raise HTTPException(status_code=404, detail=f"Delete job with id {job_id} not found")
+
+    return {"job": make_serializable(job.to_dict())}
+
 @app.get("/get-workflows-by-organization")
 async def get_workflows_by_organization(organization_id: str):
-    collection_ref = db.collection("workflows").where("organization", "==", db.document(f"organizations/{organization_id}"))
+    collection_ref = repository.workflows_by_organization(organization_id)
     docs = collection_ref.stream()
 
     data = []
-    for doc in docs:
+    async for doc in docs:
         raw_data = doc.to_dict()
         serializable_data = make_serializable(raw_data)
-
-        for key, value in serializable_data.items():
-            if isinstance(value, firestore.DocumentReference):
-                serializable_data[key] = await resolve_document_reference(value)
-
         data.append({"id": doc.id, **serializable_data})
 
+    await resolve_document_references(data)
+
     if not data:
         raise HTTPException(status_code=404, detail="No data found for the specified user")
 
@@ -523,20 +1916,18 @@ async def get_workflows_by_organization(organization_id: str):
 
 @app.get("/get-nodes-by-workflow")
 async def get_workflows_by_workflow(workflow_id: str):
-    collection_ref = db.collection("nodes").where("workflow", "==", db.document(f"workflows/{workflow_id}"))
+    collection_ref = repository.nodes_by_workflow(workflow_id)
     docs = collection_ref.stream()
 
     data = []
-    for doc in docs:
+    async for doc in docs:
         raw_data = doc.to_dict()
+        raw_data.pop("content_hash", None)
         serializable_data = make_serializable(raw_data)
-
-        for key, value in serializable_data.items():
-            if isinstance(value, firestore.DocumentReference):
-                serializable_data[key] = await resolve_document_reference(value)
-
         data.append({"id": doc.id, **serializable_data})
 
+    await resolve_document_references(data)
+
     if not data:
         return {"nodes": []}
 
@@ -544,26 +1935,120 @@ async def get_workflows_by_workflow(workflow_id: str):
 
 @app.get("/get-edges-by-workflow")
 async def get_edges_by_workflow(workflow_id: str):
-    collection_ref = db.collection("edges").where("workflow", "==", db.document(f"workflows/{workflow_id}"))
+    collection_ref = repository.edges_by_workflow(workflow_id)
     docs = collection_ref.stream()
 
     data = []
-    for doc in docs:
+    async for doc in docs:
         raw_data = doc.to_dict()
+        raw_data.pop("content_hash", None)
         serializable_data = make_serializable(raw_data)
-
-        for key, value in serializable_data.items():
-            if isinstance(value, firestore.DocumentReference):
-                serializable_data[key] = await resolve_document_reference(value)
-
         data.append({"id": doc.id, **serializable_data})
 
+    await resolve_document_references(data)
+
     if not data:
         return {"edge": []}
 
     return {"edges": data}
 
 
+def node_document(node: Dict[str, Any], workflow_ref: firestore.AsyncDocumentReference) -> Dict[str, Any]:
+    return {
+        "type": node.get("type"),
+        "position": node.get("position", {}),
+        "data": node.get("data", {}),
+        "width": node.get("width"),
+        "height": node.get("height"),
+        "selected": node.get("selected", False),
+        "positionAbsolute": node.get("positionAbsolute", {}),
+        "dragging": node.get("dragging", False),
+        "workflow": workflow_ref
+    }
+
+
+def edge_document(edge: Dict[str, Any], workflow_ref: firestore.AsyncDocumentReference) -> Dict[str, Any]:
+    return {
+        "source": edge.get("source"),
+        "sourceHandle": edge.get("sourceHandle"),
+        "target": edge.get("target"),
+        "targetHandle": edge.get("targetHandle"),
+        "workflow": workflow_ref
+    }
+
+
+def content_hash(document: Dict[str, Any]) -> str:
+    content = {key: value for key, value in document.items() if key not in ("workflow", "content_hash")}
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def diff_graph_items(collection: str, incoming: List[Dict[str, Any]], existing: List[firestore.DocumentSnapshot],
+                     build_document, workflow_ref: firestore.AsyncDocumentReference):
+    stored = {doc.id: doc.to_dict() for doc in existing}
+    items = {item["id"]: item for item in incoming if item.get("id")}
+
+    operations = []
+    summary = {"created": 0, "updated": 0, "deleted": 0, "unchanged": 0}
+    for item_id, item in items.items():
+        document = build_document(item, workflow_ref)
+        document["content_hash"] = content_hash(document)
+        current = stored.get(item_id)
+        if current is None:
+            summary["created"] += 1
+        elif (current.get("content_hash") or content_hash(current)) == document["content_hash"]:
+            summary["unchanged"] += 1
+            continue
+        else:
+            summary["updated"] += 1
+        operations.append(("set", repository.document(collection, item_id), document))
+
+    for item_id in stored:
+        if item_id not in items:
+            summary["deleted"] += 1
+            operations.append(("delete", repository.document(collection, item_id), None))
+
+    return operations, summary
+
+
+@app.get("/get-workflow-graph")
+async def get_workflow_graph(workflow_id: str, request: Request, response: Response):
+    workflow_ref = repository.workflow(workflow_id)
+    workflow_doc = await workflow_ref.get()
+    if not workflow_doc.exists:
+        raise HTTPException(status_code=404, detail=f"Workflow with id {workflow_id} not found")
+
+    workflow_data = workflow_doc.to_dict()
+    workflow = {"id": workflow_id, **make_serializable(workflow_data)}
+    await resolve_document_references([workflow])
+
+    # graph_version covers the nodes and edges; the embedded created_by and organization documents change
+    # without bumping it, so the resolved workflow is hashed in, along with the negotiated format.
+    workflow_hash = hashlib.sha256(
+        orjson.dumps(workflow, default=encode_value, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    ).hexdigest()[:16]
+    etag = f'"{workflow_id}-{workflow_data.get("graph_version", 0)}-{negotiate_format(request)}-{workflow_hash}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    nodes_docs, edges_docs = await asyncio.gather(
+        stream_documents(repository.nodes_by_workflow(workflow_id)),
+        stream_documents(repository.edges_by_workflow(workflow_id)),
+    )
+
+    def graph_items(docs):
+        items = []
+        for doc in docs:
+            raw_data = doc.to_dict()
+            raw_data.pop("content_hash", None)
+            raw_data["workflow"] = workflow_id
+            items.append({"id": doc.id, **make_serializable(raw_data)})
+        return items
+
+    response.headers.update(headers)
+    return {"workflow": workflow, "nodes": graph_items(nodes_docs), "edges": graph_items(edges_docs)}
+
+
 @app.post("/create-node")
 async def create_node(workflow_id: str, node_data: dict = Body(...)):
 
@@ -574,24 +2059,18 @@ async def create_node(workflow_id: str, node_data: dict = Body(...)):
         raise HTTPException(status_code=400, detail="Node ID is required")
 
     try:
-        workflow_ref = db.collection("workflows").document(workflow_id)
+        workflow_ref = repository.workflow(workflow_id)
 
         node_id = node_data["id"]
-        node_ref = db.collection("nodes").document(node_id)
-
-        node_document = {
-            "type": node_data.get("type"),
-            "position": node_data.get("position", {}),
-            "data": node_data.get("data", {}),
-            "width": node_data.get("width"),
-            "height": node_data.get("height"),
-            "selected": node_data.get("selected", False),
-            "positionAbsolute": node_data.get("positionAbsolute", {}),
-            "dragging": node_data.get("dragging", False),
-            "workflow": workflow_ref
-        }
+        node_ref = repository.node(node_id)
+
+        document = node_document(node_data, workflow_ref)
+        document["content_hash"] = content_hash(document)
 
-        node_ref.set(node_document, merge=True)
+        batch = repository.batch()
+        batch.set(node_ref, document, merge=True)
+        batch.update(workflow_ref, {"graph_version": firestore.Increment(1)})
+        await batch.commit()
 
         return {"node": "Node created"}
 
@@ -609,199 +2088,1008 @@ async def update_nodes(nodes_data: dict = Body(...)):
         raise HTTPException(status_code=400, detail="workflow_id is required")
 
     try:
-        workflow_ref = db.collection("workflows").document(workflow_id)
-
-        existing_nodes_query = db.collection("nodes").where("workflow", "==", workflow_ref).stream()
-        existing_edges_query = db.collection("edges").where("workflow", "==", workflow_ref).stream()
-
-        existing_node_ids = set()
-        incoming_node_ids = set(node.get("id") for node in nodes)
-
-        existing_edge_ids = set()
-        incoming_edge_ids = set(edge.get("id") for edge in edges)
+        workflow_ref = repository.workflow(workflow_id)
+
+        existing_nodes, existing_edges = await asyncio.gather(
+            stream_documents(repository.nodes_by_workflow(workflow_id)),
+            stream_documents(repository.edges_by_workflow(workflow_id)),
+        )
+
+        node_operations, nodes_summary = diff_graph_items("nodes", nodes, existing_nodes, node_document, workflow_ref)
+        edge_operations, edges_summary = diff_graph_items("edges", edges, existing_edges, edge_document, workflow_ref)
+
+        # The graph_version bump fails each chunk on its own when the workflow does not exist, so no chunk
+        # writes nodes or edges for a missing workflow. An unchanged graph writes nothing and is checked directly.
+        operations = node_operations + edge_operations
+        if not operations and not (await workflow_ref.get()).exists:
+            raise exceptions.NotFound(f"Workflow {workflow_id} not found")
+        await commit_in_batches(operations, every_batch=[("update", workflow_ref, {"graph_version": firestore.Increment(1)})])
+
+        return {
+            "message": "Nodes and edges updated successfully.",
+            "nodes": nodes_summary,
+            "edges": edges_summary,
+        }
 
-        for node in nodes:
-            node_id = node.get("id")
-            if not node_id:
-                continue
+    except exceptions.NotFound:
+        raise HTTPException(status_code=404, detail=f"Workflow with id {workflow_id} not found")
+    except Exception as e:
+        print(f"Error al actualizar nodos y aristas: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error updating nodes and edges: {str(e)}")
 
-            node_ref = db.collection("nodes").document(node_id)
-            node_data = {
-                "type": node.get("type"),
-                "position": node.get("position", {}),
-                "data": node.get("data", {}),
-                "width": node.get("width"),
-                "height": node.get("height"),
-                "selected": node.get("selected", False),
-                "positionAbsolute": node.get("positionAbsolute", {}),
-                "dragging": node.get("dragging", False),
-                "workflow": workflow_ref
+# -------------------------------------------------------------- SUBSCRIPTIONS --------------------------------------------------------------
+SUBSCRIPTION_QUEUE_SIZE = int(os.getenv("SUBSCRIPTION_QUEUE_SIZE", "1000"))
+SUBSCRIPTION_HEARTBEAT = 15
+
+
+def subscription_document(doc) -> Dict[str, Any]:
+    data = doc.to_dict() or {}
+    data.pop("content_hash", None)
+    return {"id": doc.id, **data}
+
+
+def subscription_event(event: str, data: Dict[str, Any]) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + dumps_json(data) + b"\n\n"
+
+
+class Subscriber:
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=SUBSCRIPTION_QUEUE_SIZE)
+
+    def push(self, message: Optional[bytes]):
+        self.loop.call_soon_threadsafe(self._put, message)
+
+    def _put(self, message: Optional[bytes]):
+        # A client that cannot keep up is cut off; it reconnects and starts again from a fresh snapshot.
+        if self.queue.full():
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(subscription_event("error", {"detail": "Subscriber fell behind, reconnect to resync"}))
+            self.queue.put_nowait(None)
+            return
+        self.queue.put_nowait(message)
+
+
+class SubscriptionScope:
+    def __init__(self, queries: Dict[str, Any]):
+        self.queries = queries
+        self.documents = {name: {} for name in queries}
+        self.ready = set()
+        self.subscribers = set()
+        self.watches = []
+
+
+class SubscriptionHub:
+    # One set of Firestore snapshot listeners per scope, shared by every connected client. Each change is
+    # encoded once and the same bytes are queued for all subscribers of the scope.
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._scopes = {}
+
+    def subscribe(self, key: Tuple[str, str], build_queries, loop: asyncio.AbstractEventLoop) -> Subscriber:
+        subscriber = Subscriber(loop)
+        with self._lock:
+            scope = self._scopes.get(key)
+            if scope is None:
+                scope = self._scopes[key] = SubscriptionScope(build_queries())
+                scope.subscribers.add(subscriber)
+                for name, query in scope.queries.items():
+                    callback = functools.partial(self._on_snapshot, key, scope, name)
+                    scope.watches.append(query.on_snapshot(callback))
+            else:
+                scope.subscribers.add(subscriber)
+                for name in scope.ready:
+                    subscriber.push(self._snapshot_event(scope, name))
+        return subscriber
+
+    async def unsubscribe(self, key: Tuple[str, str], subscriber: Subscriber):
+        with self._lock:
+            scope = self._scopes.get(key)
+            if scope is None:
+                return
+            scope.subscribers.discard(subscriber)
+            if scope.subscribers:
+                return
+            del self._scopes[key]
+
+        # Stopping a watch joins its thread, whose callback takes self._lock, so it runs unlocked and off the loop.
+        for watch in scope.watches:
+            await asyncio.to_thread(watch.unsubscribe)
+
+    def _snapshot_event(self, scope: SubscriptionScope, name: str) -> bytes:
+        return subscription_event("snapshot", {"collection": name, "documents": list(scope.documents[name].values())})
+
+    def _on_snapshot(self, key, scope: SubscriptionScope, name: str, docs, changes, read_time):
+        with self._lock:
+            if self._scopes.get(key) is not scope:
+                return
+
+            if name not in scope.ready:
+                scope.documents[name] = {doc.id: subscription_document(doc) for doc in docs}
+                scope.ready.add(name)
+                message = self._snapshot_event(scope, name)
+            else:
+                deltas = []
+                for change in changes:
+                    change_type = change.type.name.lower()
+                    if change_type == "removed":
+                        scope.documents[name].pop(change.document.id, None)
+                        deltas.append({"type": change_type, "id": change.document.id})
+                    else:
+                        document = subscription_document(change.document)
+                        scope.documents[name][change.document.id] = document
+                        deltas.append({"type": change_type, "id": change.document.id, "data": document})
+                if not deltas:
+                    return
+                message = subscription_event("changes", {"collection": name, "changes": deltas})
+
+            for subscriber in scope.subscribers:
+                subscriber.push(message)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "scopes": len(self._scopes),
+                "subscribers": sum(len(scope.subscribers) for scope in self._scopes.values()),
             }
 
-            node_ref.set(node_data, merge=True)
-            existing_node_ids.add(node_id)
 
-        for edge in edges:
-            edge_id = edge.get("id")
-            if not edge_id:
-                continue
+subscription_hub = SubscriptionHub()
 
-            edge_ref = db.collection("edges").document(edge_id)
-            edge_data = {
-                "source": edge.get("source"),
-                "sourceHandle": edge.get("sourceHandle"),
-                "target": edge.get("target"),
-                "targetHandle": edge.get("targetHandle"),
-                "workflow": workflow_ref
-            }
 
-            edge_ref.set(edge_data, merge=True)
-            existing_edge_ids.add(edge_id)
+def subscription_response(key: Tuple[str, str], build_queries) -> StreamingResponse:
+    subscriber = subscription_hub.subscribe(key, build_queries, asyncio.get_running_loop())
 
-        for existing_node in existing_nodes_query:
-            if existing_node.id not in incoming_node_ids:
-                db.collection("nodes").document(existing_node.id).delete()
+    async def event_stream():
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscriber.queue.get(), timeout=SUBSCRIPTION_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield b": keep-alive\n\n"
+                    continue
+                if message is None:
+                    break
+                yield message
+        finally:
+            await subscription_hub.unsubscribe(key, subscriber)
 
-        for existing_edge in existing_edges_query:
-            if existing_edge.id not in incoming_edge_ids:
-                db.collection("edges").document(existing_edge.id).delete()
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
-        return {"message": "Nodes and edges updated successfully."}
 
-    except Exception as e:
-        print(f"Error al actualizar nodos y aristas: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error updating nodes and edges: {str(e)}")
+@app.get("/subscribe-tasks")
+async def subscribe_tasks(organization_id: str):
+    def build_queries():
+        return {"tasks": repository.listener().tasks(organization_id)}
 
-# -------------------------------------------------------------- PRODUCTS CRUD --------------------------------------------------------------
-@app.get("/get-products")
-async def get_products(country: str):
-    collection_ref = db.collection("maps_data").where("country", "==", country)
-    docs = collection_ref.stream()
+    return subscription_response(("organization", organization_id), build_queries)
 
-    data = []
 
-    async def fetch_data(doc):
-        data.append({"id": doc.id, **doc.to_dict()})
+@app.get("/subscribe-workflow-graph")
+async def subscribe_workflow_graph(workflow_id: str):
+    def build_queries():
+        listener = repository.listener()
+        return {"nodes": listener.nodes_by_workflow(workflow_id), "edges": listener.edges_by_workflow(workflow_id)}
 
-    tasks = [fetch_data(doc) for doc in docs]
-    await asyncio.gather(*tasks)
+    return subscription_response(("workflow", workflow_id), build_queries)
 
-    if not data:
-        raise HTTPException(status_code=404, detail="No data found for the specified city")
 
-    return {"products": data}
+# -------------------------------------------------------------- PRODUCTS CRUD --------------------------------------------------------------
+MAPS_DATA_CATEGORICAL_FIELDS = ("country", "city", "route", "distributor_type", "isocrona")
+MAPS_DATA_NUMERIC_FIELDS = ("sales_units", "sales_liters", "sales_usd")
+MAPS_DATA_INDEX_FIELDS = ("route", "city", "distributor_type")
+MAPS_DATA_STORE_TIMEOUT = float(os.getenv("MAPS_DATA_STORE_TIMEOUT", "60"))
+# Changes are published to readers at most this often, so a burst of writes costs one snapshot copy.
+MAPS_DATA_PUBLISH_INTERVAL = float(os.getenv("MAPS_DATA_PUBLISH_INTERVAL", "0.5"))
+MAPS_DATA_MAX_PAGE_SIZE = 5000
+MAPS_DATA_STREAM_CHUNK = 500
+MAPS_DATA_GRID_CELL_DEGREES = float(os.getenv("MAPS_DATA_GRID_CELL_DEGREES", "0.1"))
+EARTH_RADIUS_KM = 6371.0088
+MAPS_DATA_CLUSTER_MAX_ZOOM = 20
+MAPS_DATA_CLUSTER_CELLS_PER_TILE = 4
+
+
+def parse_coordinates(value) -> Tuple[float, float]:
+    try:
+        if hasattr(value, "latitude") and hasattr(value, "longitude"):
+            return float(value.latitude), float(value.longitude)
+        if isinstance(value, dict):
+            for lat_key, lng_key in (("lat", "lng"), ("latitude", "longitude"), ("lat", "lon")):
+                if lat_key in value and lng_key in value:
+                    return float(value[lat_key]), float(value[lng_key])
+        if isinstance(value, (list, tuple)) and len(value) == 2:
+            return float(value[0]), float(value[1])
+        if isinstance(value, str) and "," in value:
+            lat, lng = value.split(",", 1)
+            return float(lat), float(lng)
+    except (TypeError, ValueError):
+        pass
+    return float("nan"), float("nan")
+
+
+def _as_float(value) -> float:
+    try:
+        return float(value) if value is not None else 0.0
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _as_number(value: float):
+    return int(value) if float(value).is_integer() else float(value)
+
+
+class MapsDataSnapshot:
+    # Immutable view of maps_data published by MapsDataStore after each batch of changes. Handlers read
+    # it without locking; the listener builds the next one on the side and swaps the reference.
+    def __init__(
+        self,
+        columns: Dict[str, np.ndarray],
+        ids: List[str],
+        records: List[Optional[Dict[str, Any]]],
+        rows: Dict[str, int],
+        categories: Dict[str, List[Any]],
+        category_codes: Dict[str, Dict[Any, int]],
+        zones: Dict[int, Dict[Tuple[int, int], Dict[str, Any]]],
+        index: Dict[int, Dict[str, Any]],
+        grid: Dict[Tuple[int, int], set],
+        country_versions: Dict[Any, int],
+        clusters: Dict[Any, List[Dict[str, np.ndarray]]],
+    ):
+        self._columns = columns
+        self._ids = ids
+        self._records = records
+        self._rows = rows
+        self._categories = categories
+        self._category_codes = category_codes
+        self._zones = zones
+        self._index = index
+        self._grid = grid
+        self._size = len(ids)
+        self.country_versions = country_versions
+        self._clusters = clusters
+
+    @classmethod
+    def empty(cls) -> "MapsDataSnapshot":
+        return cls(
+            columns={name: np.full(0, fill, dtype=dtype) for name, (dtype, fill) in MapsDataStore.COLUMNS.items()},
+            ids=[],
+            records=[],
+            rows={},
+            categories={field: [] for field in MAPS_DATA_CATEGORICAL_FIELDS},
+            category_codes={field: {} for field in MAPS_DATA_CATEGORICAL_FIELDS},
+            zones={},
+            index={},
+            grid={},
+            country_versions={},
+            clusters={},
+        )
+
+    def _cell(self, lat: float, lng: float) -> Tuple[int, int]:
+        return int(np.floor(lat / MAPS_DATA_GRID_CELL_DEGREES)), int(np.floor(lng / MAPS_DATA_GRID_CELL_DEGREES))
+
+    def _view(self, name: str) -> np.ndarray:
+        return self._columns[name]
+
+    def mask(self, **filters) -> np.ndarray:
+        mask = self._view("alive").copy()
+        for field, value in filters.items():
+            if value is None:
+                continue
+            code = self._category_codes[field].get(value)
+            if code is None:
+                return np.zeros(self._size, dtype=bool)
+            mask &= self._view(field) == code
+        return mask
+
+    def page(self, limit: Optional[int] = None, after: Optional[int] = None, **filters) -> Tuple[List[Tuple[str, Dict[str, Any]]], Optional[int]]:
+        # Rows are kept in insertion order, so the insertion sequence number doubles as a stable cursor.
+        mask = self.mask(**filters)
+        if after is not None:
+            mask &= self._view("seq") > after
+        rows = np.flatnonzero(mask)
+        next_seq = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_seq = int(self._columns["seq"][rows[-1]])
+        return [(self._ids[row], self._records[row]) for row in rows], next_seq
+
+    def _candidates(self, min_lat: float, min_lng: float, max_lat: float, max_lng: float) -> np.ndarray:
+        low_lat, low_lng = self._cell(min_lat, min_lng)
+        high_lat, high_lng = self._cell(max_lat, max_lng)
+        if (high_lat - low_lat + 1) * (high_lng - low_lng + 1) <= len(self._grid):
+            cells = (
+                (cell_lat, cell_lng)
+                for cell_lat in range(low_lat, high_lat + 1)
+                for cell_lng in range(low_lng, high_lng + 1)
+            )
+        else:
+            cells = (cell for cell in self._grid if low_lat <= cell[0] <= high_lat and low_lng <= cell[1] <= high_lng)
+        rows = [self._rows[doc_id] for cell in cells for doc_id in self._grid.get(cell, ())]
+        return np.sort(np.array(rows, dtype=np.int64))
+
+    def _filter(self, rows: np.ndarray, **filters) -> np.ndarray:
+        keep = self._view("alive")[rows]
+        for field, value in filters.items():
+            if value is None:
+                continue
+            code = self._category_codes[field].get(value)
+            if code is None:
+                return rows[:0]
+            keep &= self._view(field)[rows] == code
+        return rows[keep]
+
+    def within_bounds(self, min_lat: float, min_lng: float, max_lat: float, max_lng: float, **filters) -> List[Dict[str, Any]]:
+        rows = self._filter(self._candidates(min_lat, min_lng, max_lat, max_lng), **filters)
+        lat, lng = self._view("lat")[rows], self._view("lng")[rows]
+        rows = rows[(lat >= min_lat) & (lat <= max_lat) & (lng >= min_lng) & (lng <= max_lng)]
+        return [{"id": self._ids[row], **self._records[row]} for row in rows]
+
+    def within_radius(self, lat: float, lng: float, radius_km: float, **filters) -> List[Dict[str, Any]]:
+        lat_delta = np.degrees(radius_km / EARTH_RADIUS_KM)
+        lng_delta = lat_delta / max(np.cos(np.radians(lat)), 1e-6)
+        rows = self._filter(
+            self._candidates(lat - lat_delta, lng - lng_delta, lat + lat_delta, lng + lng_delta),
+            **filters
+        )
+
+        point_lat, point_lng = np.radians(self._view("lat")[rows]), np.radians(self._view("lng")[rows])
+        origin_lat, origin_lng = np.radians(lat), np.radians(lng)
+        haversine = (
+            np.sin((point_lat - origin_lat) / 2) ** 2
+            + np.cos(origin_lat) * np.cos(point_lat) * np.sin((point_lng - origin_lng) / 2) ** 2
+        )
+        distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(haversine, 1.0)))
+
+        inside = distances <= radius_km
+        rows, distances = rows[inside], distances[inside]
+        order = np.argsort(distances, kind="stable")
+        return [
+            {"id": self._ids[row], **self._records[row], "distance_km": float(distance)}
+            for row, distance in zip(rows[order], distances[order])
+        ]
+
+    def countries(self) -> List[Any]:
+        return sorted((self._categories["country"][code] for code in self._index), key=str)
+
+    def values(self, country: str) -> Optional[Dict[str, Any]]:
+        entry = self._index.get(self._category_codes["country"].get(country))
+        if entry is None:
+            return None
+        return {
+            "count": entry["count"],
+            **{
+                field: sorted(
+                    ({"value": self._categories[field][code], "count": count} for code, count in entry[field].items()),
+                    key=lambda item: str(item["value"])
+                )
+                for field in MAPS_DATA_INDEX_FIELDS
+            }
+        }
 
-@app.get("/distributor-data")
-async def get_distributor_data(country: str, distributor_type: str):
-    collection_ref = (
-        db.collection("maps_data")
-        .where("country", "==", country)
-        .where("distributor_type", "==", distributor_type)
-    )
-    docs = collection_ref.stream()
+    def zone_summaries(self, country: str) -> List[Dict[str, Any]]:
+        code = self._category_codes["country"].get(country)
+        zones = sorted(self._zones.get(code, {}).values(), key=lambda zone: (str(zone["city"]), str(zone["route"])))
+        return [
+            {
+                "city": zone["city"],
+                "route": zone["route"],
+                "isocrona": zone["isocrona"],
+                "sales_summary": {
+                    "total_units": _as_number(zone["sales_units"]),
+                    "total_liters": _as_number(zone["sales_liters"]),
+                    "total_usd": float(zone["sales_usd"]),
+                },
+                "point_count": zone["count"],
+                "zone": zone["code"],
+            }
+            for zone in zones
+        ]
+
+    def _build_clusters(self, country: str) -> List[Dict[str, np.ndarray]]:
+        rows = np.flatnonzero(self.mask(country=country))
+        lat, lng = self._view("lat")[rows], self._view("lng")[rows]
+        located = ~(np.isnan(lat) | np.isnan(lng))
+        rows = rows[located]
+        level = {
+            "lat": lat[located],
+            "lng": lng[located],
+            "count": np.ones(len(rows)),
+            **{field: self._view(field)[rows] for field in MAPS_DATA_NUMERIC_FIELDS},
+        }
 
-    data = []
+        # Each zoom level merges the clusters of the level below it that share a grid cell, so the
+        # whole hierarchy costs one pass per level over an ever smaller set of clusters.
+        levels = [None] * (MAPS_DATA_CLUSTER_MAX_ZOOM + 1)
+        for zoom in range(MAPS_DATA_CLUSTER_MAX_ZOOM, -1, -1):
+            if not len(level["count"]):
+                levels[zoom] = level
+                continue
+            # One int64 key per cell, latitude-major, so a flat unique groups the clusters in cell order.
+            cell = 360.0 / (2 ** zoom) / MAPS_DATA_CLUSTER_CELLS_PER_TILE
+            lat_cells = np.floor(level["lat"] / cell).astype(np.int64)
+            lng_cells = np.floor(level["lng"] / cell).astype(np.int64)
+            lat_cells -= lat_cells.min()
+            lng_cells -= lng_cells.min()
+            keys = lat_cells * (int(lng_cells.max()) + 1) + lng_cells
+            _, inverse = np.unique(keys, return_inverse=True)
+            count = np.bincount(inverse, weights=level["count"])
+            level = {
+                "lat": np.bincount(inverse, weights=level["lat"] * level["count"]) / count,
+                "lng": np.bincount(inverse, weights=level["lng"] * level["count"]) / count,
+                "count": count,
+                **{field: np.bincount(inverse, weights=level[field]) for field in MAPS_DATA_NUMERIC_FIELDS},
+            }
+            levels[zoom] = level
+        return levels
+
+    def clusters(self, country: str, zoom: int) -> List[Dict[str, Any]]:
+        # Hierarchies are built by the listener before the snapshot is published; only countries without
+        # data are built here, which is immediate.
+        levels = self._clusters.get(country)
+        if levels is None:
+            levels = self._build_clusters(country)
+
+        level = levels[zoom]
+        return [
+            {
+                "lat": float(level["lat"][index]),
+                "lng": float(level["lng"][index]),
+                "point_count": int(level["count"][index]),
+                "sales_summary": {
+                    "total_units": _as_number(level["sales_units"][index]),
+                    "total_liters": _as_number(level["sales_liters"][index]),
+                    "total_usd": float(level["sales_usd"][index]),
+                },
+            }
+            for index in range(len(level["count"]))
+        ]
+
+    def zones(self, country: str, include_points: bool = True) -> List[Dict[str, Any]]:
+        summaries = self.zone_summaries(country)
+        rows = np.flatnonzero(self.mask(country=country) & (self._view("zone") >= 0))
+        order = rows[np.argsort(self._view("zone")[rows], kind="stable")]
+        codes, starts = np.unique(self._view("zone")[order], return_index=True)
+        members = dict(zip(codes.tolist(), np.split(order, starts[1:])))
+
+        zones = []
+        for summary in summaries:
+            records = [self._records[row] for row in members.get(summary.pop("zone"), [])]
+            summary.pop("point_count")
+            zone = {**summary}
+            if include_points:
+                zone["points"] = [record.get("gps_coordinates") for record in records]
+            zones.append({
+                **zone,
+                "point_data": [
+                    {
+                        "gps_coordinates": record.get("gps_coordinates"),
+                        "sales_units": record.get("sales_units"),
+                        "sales_liters": record.get("sales_liters"),
+                        "sales_usd": record.get("sales_usd"),
+                    }
+                    for record in records
+                ]
+            })
+        return zones
+
+
+class MapsDataStore:
+    # Process-local columnar copy of maps_data. Categorical fields are stored as integer codes, numeric
+    # fields as float64 arrays. A Firestore snapshot listener delivers the initial load and then only
+    # the documents that changed. Only the listener takes self._lock; readers use the published snapshot.
+    COLUMNS = {
+        **{field: (np.int32, -1) for field in MAPS_DATA_CATEGORICAL_FIELDS},
+        **{field: (np.float64, 0.0) for field in MAPS_DATA_NUMERIC_FIELDS},
+        "lat": (np.float64, np.nan),
+        "lng": (np.float64, np.nan),
+        "seq": (np.int64, -1),
+        "zone": (np.int32, -1),
+        "alive": (np.bool_, False),
+    }
 
-    async def fetch_data(doc):
-        data.append({"id": doc.id, **doc.to_dict()})
+    def __init__(self):
+        self.ready = threading.Event()
+        self.version = 0
+        self.country_versions = {}
+        self.snapshot = MapsDataSnapshot.empty()
+        self._lock = threading.RLock()
+        self._watch_lock = threading.Lock()
+        self._watch = None
+        self._publish_timer = None
+        self._dirty = False
+        self._categories = {field: [] for field in MAPS_DATA_CATEGORICAL_FIELDS}
+        self._category_codes = {field: {} for field in MAPS_DATA_CATEGORICAL_FIELDS}
+        self._zones = {}
+        self._zone_codes = {}
+        self._index = {}
+        self._grid = {}
+        self._owned_cells = set()
+        self._cells = {}
+        self._columns = {name: np.full(1024, fill, dtype=dtype) for name, (dtype, fill) in self.COLUMNS.items()}
+        self._rows = {}
+        self._ids = []
+        self._records = []
+        self._size = 0
+        self._dead = 0
+        self._next_seq = 0
+
+    def start(self):
+        with self._watch_lock:
+            if self._watch is None:
+                self._watch = get_analytics_repository().maps_data().on_snapshot(self._on_snapshot)
+
+    def stop(self):
+        with self._watch_lock:
+            if self._watch is not None:
+                self._watch.unsubscribe()
+                self._watch = None
+        with self._lock:
+            if self._publish_timer is not None:
+                self._publish_timer.cancel()
+                self._publish_timer = None
+
+    def _on_snapshot(self, docs, changes, read_time):
+        with self._lock:
+            for change in changes:
+                if change.type.name == "REMOVED":
+                    self._remove(change.document.id)
+                else:
+                    self._upsert(change.document.id, change.document.to_dict())
+            if self._dead > 1024 and self._dead * 2 > self._size:
+                self._compact()
+            self._dirty = True
+            if not self.ready.is_set():
+                self._publish()
+            elif self._publish_timer is None:
+                self._publish_timer = threading.Timer(MAPS_DATA_PUBLISH_INTERVAL, self._publish_pending)
+                self._publish_timer.daemon = True
+                self._publish_timer.start()
+        self.ready.set()
+
+    def _publish_pending(self):
+        with self._lock:
+            self._publish_timer = None
+            if self._dirty:
+                self._publish()
+
+    def _publish(self):
+        # Copies cost one pass over the columns plus the aggregates, which is why later batches are
+        # coalesced; grid cells are shared with the previous snapshot and copied by the writer before
+        # it next changes them.
+        self._dirty = False
+        previous = self.snapshot
+        country_versions = dict(self.country_versions)
+        clusters = {
+            country: levels
+            for country, levels in previous._clusters.items()
+            if previous.country_versions.get(country) == country_versions.get(country)
+        }
+        self._owned_cells = set()
+        snapshot = MapsDataSnapshot(
+            columns={name: column[:self._size].copy() for name, column in self._columns.items()},
+            ids=list(self._ids),
+            records=list(self._records),
+            rows=dict(self._rows),
+            categories={field: list(values) for field, values in self._categories.items()},
+            category_codes={field: dict(codes) for field, codes in self._category_codes.items()},
+            zones={country: {key: dict(zone) for key, zone in zones.items()} for country, zones in self._zones.items()},
+            index={
+                country: {"count": entry["count"], **{field: dict(entry[field]) for field in MAPS_DATA_INDEX_FIELDS}}
+                for country, entry in self._index.items()
+            },
+            grid=dict(self._grid),
+            country_versions=country_versions,
+            clusters=clusters,
+        )
+        # Cluster hierarchies of changed countries are rebuilt here, in the listener thread, so requests
+        # only ever read them.
+        for country in snapshot.countries():
+            if country not in clusters:
+                clusters[country] = snapshot._build_clusters(country)
+        self.snapshot = snapshot
+
+    def _ensure_capacity(self, size: int):
+        capacity = len(self._columns["alive"])
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        for name, (dtype, fill) in self.COLUMNS.items():
+            column = np.full(capacity, fill, dtype=dtype)
+            column[:self._size] = self._columns[name][:self._size]
+            self._columns[name] = column
+
+    def _encode(self, field: str, value) -> int:
+        if value is None:
+            return -1
+        try:
+            codes = self._category_codes[field]
+            if value not in codes:
+                codes[value] = len(self._categories[field])
+                self._categories[field].append(value)
+            return codes[value]
+        except TypeError:
+            return -1
+
+    def _touch(self, row: int):
+        self.version += 1
+        code = self._columns["country"][row]
+        if code >= 0:
+            country = self._categories["country"][code]
+            self.country_versions[country] = self.country_versions.get(country, 0) + 1
+
+    def _upsert(self, doc_id: str, data: Dict[str, Any]):
+        row = self._rows.get(doc_id)
+        if row is None:
+            row = self._size
+            self._ensure_capacity(row + 1)
+            self._size += 1
+            self._rows[doc_id] = row
+            self._ids.append(doc_id)
+            self._records.append(None)
+            self._columns["seq"][row] = self._next_seq
+            self._next_seq += 1
+        else:
+            self._touch(row)
+            self._unaggregate(row)
+            self._count_values(row, -1)
+
+        for field in MAPS_DATA_CATEGORICAL_FIELDS:
+            self._columns[field][row] = self._encode(field, data.get(field))
+        for field in MAPS_DATA_NUMERIC_FIELDS:
+            self._columns[field][row] = _as_float(data.get(field))
+        self._columns["lat"][row], self._columns["lng"][row] = parse_coordinates(data.get("gps_coordinates"))
+        self._columns["alive"][row] = True
+        self._records[row] = data
+        self._place(doc_id, row)
+        self._aggregate(row)
+        self._count_values(row, 1)
+        self._touch(row)
+
+    def _remove(self, doc_id: str):
+        row = self._rows.pop(doc_id, None)
+        if row is None:
+            return
+        self._touch(row)
+        self._unaggregate(row)
+        self._count_values(row, -1)
+        self._unplace(doc_id)
+        self._columns["alive"][row] = False
+        self._records[row] = None
+        self._dead += 1
+
+    def _cell(self, lat: float, lng: float) -> Tuple[int, int]:
+        return int(np.floor(lat / MAPS_DATA_GRID_CELL_DEGREES)), int(np.floor(lng / MAPS_DATA_GRID_CELL_DEGREES))
+
+    def _cell_members(self, cell: Tuple[int, int]) -> set:
+        # Cells published in a snapshot are copied once before their first change after publishing.
+        members = self._grid.get(cell)
+        if members is None or cell not in self._owned_cells:
+            members = self._grid[cell] = set(members or ())
+            self._owned_cells.add(cell)
+        return members
+
+    def _place(self, doc_id: str, row: int):
+        # Uniform lat/lng grid; cells hold document ids so compaction does not have to rebuild it.
+        self._unplace(doc_id)
+        lat, lng = self._columns["lat"][row], self._columns["lng"][row]
+        if np.isnan(lat) or np.isnan(lng):
+            return
+        cell = self._cell(lat, lng)
+        self._cell_members(cell).add(doc_id)
+        self._cells[doc_id] = cell
+
+    def _unplace(self, doc_id: str):
+        cell = self._cells.pop(doc_id, None)
+        if cell is None:
+            return
+        members = self._cell_members(cell)
+        members.discard(doc_id)
+        if not members:
+            del self._grid[cell]
+            self._owned_cells.discard(cell)
+
+    def _aggregate(self, row: int):
+        # Zone totals are kept per country and (city, route), so they only change by the row's own
+        # contribution instead of being re-summed from every point.
+        country, city, route = (int(self._columns[field][row]) for field in ("country", "city", "route"))
+        if country < 0 or city < 0 or route < 0:
+            self._columns["zone"][row] = -1
+            return
+
+        zone = self._zones.setdefault(country, {}).get((city, route))
+        if zone is None:
+            isocrona = self._columns["isocrona"][row]
+            zone = {
+                "code": self._zone_codes.setdefault((country, city, route), len(self._zone_codes)),
+                "city": self._categories["city"][city],
+                "route": self._categories["route"][route],
+                "isocrona": self._categories["isocrona"][isocrona] if isocrona >= 0 else "Unknown",
+                "count": 0,
+                **{field: 0.0 for field in MAPS_DATA_NUMERIC_FIELDS},
+            }
+            self._zones[country][(city, route)] = zone
+
+        zone["count"] += 1
+        for field in MAPS_DATA_NUMERIC_FIELDS:
+            zone[field] += self._columns[field][row]
+        self._columns["zone"][row] = zone["code"]
+
+    def _unaggregate(self, row: int):
+        if self._columns["zone"][row] < 0:
+            return
+        country, city, route = (int(self._columns[field][row]) for field in ("country", "city", "route"))
+        zone = self._zones[country][(city, route)]
+        zone["count"] -= 1
+        for field in MAPS_DATA_NUMERIC_FIELDS:
+            zone[field] -= self._columns[field][row]
+        if not zone["count"]:
+            del self._zones[country][(city, route)]
+        self._columns["zone"][row] = -1
+
+    def _count_values(self, row: int, delta: int):
+        country = int(self._columns["country"][row])
+        if country < 0:
+            return
+        entry = self._index.setdefault(country, {"count": 0, **{field: {} for field in MAPS_DATA_INDEX_FIELDS}})
+        entry["count"] += delta
+        for field in MAPS_DATA_INDEX_FIELDS:
+            code = int(self._columns[field][row])
+            if code < 0:
+                continue
+            counts = entry[field]
+            counts[code] = counts.get(code, 0) + delta
+            if not counts[code]:
+                del counts[code]
+        if not entry["count"]:
+            del self._index[country]
+
+    def rebuild_zones(self) -> int:
+        with self._lock:
+            self._zones = {}
+            for row in np.flatnonzero(self._columns["alive"][:self._size]):
+                self._aggregate(row)
+            self.version += 1
+            for country in self._categories["country"]:
+                self.country_versions[country] = self.country_versions.get(country, 0) + 1
+            self._publish()
+            return sum(len(zones) for zones in self._zones.values())
+
+    def _compact(self):
+        keep = np.flatnonzero(self._columns["alive"][:self._size])
+        for name, (dtype, fill) in self.COLUMNS.items():
+            column = np.full(len(self._columns[name]), fill, dtype=dtype)
+            column[:len(keep)] = self._columns[name][keep]
+            self._columns[name] = column
+        self._ids = [self._ids[row] for row in keep]
+        self._records = [self._records[row] for row in keep]
+        self._rows = {doc_id: row for row, doc_id in enumerate(self._ids)}
+        self._size = len(keep)
+        self._dead = 0
+
+maps_data_store = MapsDataStore()
+
+
+async def get_maps_data_store() -> MapsDataSnapshot:
+    maps_data_store.start()
+    if not maps_data_store.ready.is_set():
+        if not await asyncio.to_thread(maps_data_store.ready.wait, MAPS_DATA_STORE_TIMEOUT):
+            raise HTTPException(status_code=503, detail="maps_data is still loading, try again shortly")
+    return maps_data_store.snapshot
+
+
+def project_maps_data(doc_id: str, record: Dict[str, Any], fields: Optional[List[str]]) -> Dict[str, Any]:
+    if fields is None:
+        return {"id": doc_id, **record}
+    return {"id": doc_id, **{field: record[field] for field in fields if field in record}}
+
+
+def ndjson_lines(items: List[Tuple[str, Dict[str, Any]]], fields: Optional[List[str]]):
+    for start in range(0, len(items), MAPS_DATA_STREAM_CHUNK):
+        yield b"".join(
+            dumps_json(project_maps_data(doc_id, record, fields)) + b"\n"
+            for doc_id, record in items[start:start + MAPS_DATA_STREAM_CHUNK]
+        )
+
+
+async def query_maps_data(
+    request: Request,
+    key: str,
+    not_found: str,
+    limit: Optional[int],
+    start_after: Optional[str],
+    fields: Optional[str],
+    stream: bool,
+    **filters
+):
+    if limit is not None and not 1 <= limit <= MAPS_DATA_MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAPS_DATA_MAX_PAGE_SIZE}")
+
+    after = None
+    if start_after:
+        after = decode_cursor(start_after).get("seq")
+        if not isinstance(after, int):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    store = await get_maps_data_store()
+    items, next_seq = store.page(limit=limit, after=after, **filters)
+    if not items and after is None:
+        raise HTTPException(status_code=404, detail=not_found)
+
+    next_cursor = encode_cursor({"seq": next_seq}) if next_seq is not None else None
+    projection = parse_fields(fields)
+    if stream or negotiate_format(request, tabular=True) == "ndjson":
+        headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+        return StreamingResponse(ndjson_lines(items, projection), media_type=RESPONSE_CONTENT_TYPES["ndjson"], headers=headers)
+
+    content = {key: [project_maps_data(doc_id, record, projection) for doc_id, record in items]}
+    if limit is not None:
+        content["next_cursor"] = next_cursor
+    return content
 
-    tasks = [fetch_data(doc) for doc in docs]
-    await asyncio.gather(*tasks)
 
-    if not data:
-        raise HTTPException(status_code=404, detail="No data found for the specified filters")
+@app.get("/get-products")
+@tabular("products")
+async def get_products(
+    country: str,
+    request: Request,
+    limit: Optional[int] = None,
+    start_after: Optional[str] = None,
+    fields: Optional[str] = None,
+    stream: bool = False
+):
+    return await query_maps_data(
+        request, "products", "No data found for the specified city", limit, start_after, fields, stream,
+        country=country
+    )
 
-    return {"distributors": data}
+@app.get("/distributor-data")
+@tabular("distributors")
+async def get_distributor_data(
+    country: str,
+    distributor_type: str,
+    request: Request,
+    limit: Optional[int] = None,
+    start_after: Optional[str] = None,
+    fields: Optional[str] = None,
+    stream: bool = False
+):
+    return await query_maps_data(
+        request, "distributors", "No data found for the specified filters", limit, start_after, fields, stream,
+        country=country, distributor_type=distributor_type
+    )
 
 @app.get("/countries")
 async def get_countries():
-    collection_ref = db.collection("maps_data")
-    docs = collection_ref.stream()
-
-    countries = set()
-
-    async def fetch_country(doc):
-        doc_data = doc.to_dict()
-        if 'country' in doc_data:
-            countries.add(doc_data['country'])
-
-    tasks = [fetch_country(doc) for doc in docs]
-    await asyncio.gather(*tasks)
+    store = await get_maps_data_store()
+    countries = store.countries()
 
     if not countries:
         raise HTTPException(status_code=404, detail="No data found for the countries")
 
-    return {"countries": list(countries)}
+    return {"countries": countries}
 
 @app.get("/routes-by-country")
 async def get_routes(country: str):
-    collection_ref = db.collection("maps_data").where("country", "==", country)
-    docs = collection_ref.stream()
+    store = await get_maps_data_store()
+    values = store.values(country)
+    routes = [item["value"] for item in values["route"]] if values else []
 
-    routes = set()
-
-    async def fetch_data(doc):
-        doc_data = doc.to_dict()
-        if 'route' in doc_data:
-            routes.add(doc_data['route'])
-
-    tasks = [fetch_data(doc) for doc in docs]
-    await asyncio.gather(*tasks)
-
-    if not routes and not routes:
+    if not routes:
         raise HTTPException(status_code=404, detail="No data found for the routes")
 
     return {
         "routes": routes
     }
 
+def check_coordinate(name: str, value: float, limit: float):
+    if not math.isfinite(value) or not -limit <= value <= limit:
+        raise HTTPException(status_code=400, detail=f"{name} must be a finite number between {-limit:g} and {limit:g}")
+
+
+@app.get("/points-in-bounds")
+@tabular("points")
+async def get_points_in_bounds(
+    country: str,
+    min_lat: float,
+    min_lng: float,
+    max_lat: float,
+    max_lng: float,
+    distributor_type: Optional[str] = None
+):
+    for name, value, limit in (("min_lat", min_lat, 90), ("max_lat", max_lat, 90), ("min_lng", min_lng, 180), ("max_lng", max_lng, 180)):
+        check_coordinate(name, value, limit)
+    if min_lat > max_lat or min_lng > max_lng:
+        raise HTTPException(status_code=400, detail="min_lat/min_lng must not exceed max_lat/max_lng")
+
+    store = await get_maps_data_store()
+    points = store.within_bounds(min_lat, min_lng, max_lat, max_lng, country=country, distributor_type=distributor_type)
+    return {"points": points}
+
+@app.get("/points-near")
+@tabular("points")
+async def get_points_near(
+    country: str,
+    lat: float,
+    lng: float,
+    radius_km: float,
+    distributor_type: Optional[str] = None
+):
+    check_coordinate("lat", lat, 90)
+    check_coordinate("lng", lng, 180)
+    if not math.isfinite(radius_km) or radius_km <= 0:
+        raise HTTPException(status_code=400, detail="radius_km must be a finite number greater than 0")
+
+    store = await get_maps_data_store()
+    points = store.within_radius(lat, lng, radius_km, country=country, distributor_type=distributor_type)
+    return {"points": points}
+
+@app.get("/country-index")
+async def get_country_index(country: Optional[str] = None):
+    store = await get_maps_data_store()
+    countries = [country] if country is not None else store.countries()
+
+    index = []
+    for name in countries:
+        values = store.values(name)
+        if values is None:
+            continue
+        index.append({
+            "country": name,
+            "count": values["count"],
+            "routes": values["route"],
+            "cities": values["city"],
+            "distributor_types": values["distributor_type"],
+        })
+
+    if not index:
+        raise HTTPException(status_code=404, detail="No data found for the specified country")
+
+    return {"countries": index}
+
 @app.get("/distribution-zones")
-async def get_distribution_zones(country: str):
-    collection_ref = db.collection("maps_data").where("country", "==", country)
-    docs = collection_ref.stream()
+async def get_distribution_zones(country: str, zoom: Optional[int] = None, include_points: bool = True):
+    if zoom is not None and not 0 <= zoom <= MAPS_DATA_CLUSTER_MAX_ZOOM:
+        raise HTTPException(status_code=400, detail=f"zoom must be between 0 and {MAPS_DATA_CLUSTER_MAX_ZOOM}")
 
-    zones = {}
+    store = await get_maps_data_store()
+    if zoom is not None:
+        zones = store.zone_summaries(country)
+        if not zones:
+            raise HTTPException(status_code=404, detail="No data found for the specified country")
 
-    async def process_doc(doc):
-        doc_data = doc.to_dict()
-        zone_key = f"{doc_data['city']}-{doc_data['route']}"
-        if zone_key not in zones:
-            zones[zone_key] = {
-                "city": doc_data["city"],
-                "route": doc_data["route"],
-                "isocrona": doc_data.get("isocrona", "Unknown"),
-                "sales_summary": {
-                    "total_units": 0,
-                    "total_liters": 0,
-                    "total_usd": 0.0,
-                },
-                "points": [],
-                "point_data": []
-            }
+        for zone in zones:
+            zone.pop("zone")
+        return {"zones": zones, "zoom": zoom, "clusters": store.clusters(country, zoom)}
 
-        zones[zone_key]["sales_summary"]["total_units"] += doc_data["sales_units"]
-        zones[zone_key]["sales_summary"]["total_liters"] += doc_data["sales_liters"]
-        zones[zone_key]["sales_summary"]["total_usd"] += doc_data["sales_usd"]
+    zones = store.zones(country, include_points=include_points)
 
-        zones[zone_key]["points"].append(doc_data["gps_coordinates"])
+    if not zones:
+        raise HTTPException(status_code=404, detail="No data found for the specified country")
 
-        zones[zone_key]["point_data"].append({
-            "gps_coordinates": doc_data["gps_coordinates"],
-            "sales_units": doc_data["sales_units"],
-            "sales_liters": doc_data["sales_liters"],
-            "sales_usd": doc_data["sales_usd"],
-        })
+    return {"zones": zones}
 
-    tasks = [process_doc(doc) for doc in docs]
-    await asyncio.gather(*tasks)
+@app.get("/distribution-zones/summary")
+async def get_distribution_zones_summary(country: str):
+    store = await get_maps_data_store()
+    zones = store.zone_summaries(country)
 
     if not zones:
         raise HTTPException(status_code=404, detail="No data found for the specified country")
 
-    return {"zones": list(zones.values())}
+    for zone in zones:
+        zone.pop("zone")
+    return {"zones": zones}
 
+@app.post("/rebuild-zone-aggregates")
+async def rebuild_zone_aggregates():
+    await get_maps_data_store()
+    zones = await asyncio.to_thread(maps_data_store.rebuild_zones)
+    return {"message": "Zone aggregates rebuilt", "zones": zones}
 
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run("main:app", host="127.0.0.1", port=8080, reload=True)
+    # A single process without reload; server.py runs multiple workers and reload.
+    uvicorn.run(app, host="127.0.0.1", port=8080)
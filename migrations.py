@@ -0,0 +1,40 @@
+import argparse
+import time
+
+from google.cloud import firestore
+
+from storage import WRITE_BATCH_LIMIT
+
+
+def backfill_created_at(client: firestore.Client, collection: str, batch_size: int = WRITE_BATCH_LIMIT) -> int:
+    # Documents written before created_at existed are left out of queries ordered on it.
+    # Sets it from the document's own timestamps; documents that already have it are left untouched.
+    updated = 0
+    batch = client.batch()
+    pending = 0
+    for snapshot in client.collection(collection).select(["created_at"]).stream():
+        if snapshot.to_dict().get("created_at") is not None:
+            continue
+        batch.update(snapshot.reference, {"created_at": snapshot.create_time or snapshot.update_time})
+        pending += 1
+        if pending == batch_size:
+            batch.commit()
+            updated += pending
+            batch = client.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+        updated += pending
+    return updated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Set created_at on Firestore documents written without it.")
+    parser.add_argument("collections", nargs="*", default=["ia_answers"])
+    args = parser.parse_args()
+
+    source_client = firestore.Client()
+    for collection_id in args.collections:
+        started = time.perf_counter()
+        count = backfill_created_at(source_client, collection_id)
+        print(f"{collection_id}: {count} documents in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,226 @@
+import itertools
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from google.api_core import exceptions
+from google.cloud import firestore
+
+from storage import STORAGE_BACKENDS, SQLiteClient
+
+
+# Data access for the API. Handlers ask a repository for the references, queries and writes they need
+# instead of spelling out collections and filters, so the same handler runs on any backend.
+# FirestoreRepository runs them on Firestore clients; StorageRepository runs them on a storage.py client
+# (the embedded SQLite database, or the in-memory client of the benchmarks), which mirrors the Firestore
+# client interface but runs transactions itself.
+
+TRANSACTION_MAX_ATTEMPTS = 5
+
+
+class RepositoryTransaction:
+    # What a transaction function is given: reads go through the client the transaction belongs to.
+    def __init__(self, client, transaction):
+        self._client = client
+        self._transaction = transaction
+
+    async def get_all(self, references) -> Dict[str, firestore.DocumentSnapshot]:
+        return {
+            snapshot.reference.path: snapshot
+            async for snapshot in self._client.get_all(references, transaction=self._transaction)
+        }
+
+    def create(self, reference, document_data: Dict[str, Any]):
+        self._transaction.create(reference, document_data)
+
+    def update(self, reference, field_updates: Dict[str, Any]):
+        self._transaction.update(reference, field_updates)
+
+
+class FirestoreRepository:
+    def __init__(self, clients: List[Any]):
+        self.clients = list(clients)
+        self._clients = itertools.cycle(self.clients)
+        self._listener = None
+
+    @property
+    def client(self):
+        # Every client has its own gRPC connection, which carries about 100 concurrent calls; calls are
+        # spread over them round-robin. References and queries work with any client of the project.
+        return next(self._clients)
+
+    def listener(self) -> "FirestoreRepository":
+        # Snapshot listeners need the synchronous Firestore client.
+        if self._listener is None:
+            self._listener = FirestoreRepository([firestore.Client()])
+        return self._listener
+
+    async def connect(self):
+        # One read per client opens its connection ahead of the first request.
+        for client in self.clients:
+            await client.collection("roles").document("connect").get()
+
+    async def close(self):
+        for client in self.clients:
+            client.close()
+        if self._listener is not None:
+            await self._listener.close()
+            self._listener = None
+
+    # ------ REFERENCES ------
+    def document(self, collection: str, document_id: Optional[str] = None):
+        return self.client.collection(collection).document(document_id)
+
+    def reference(self, path: str):
+        return self.client.document(path)
+
+    def user(self, user_id: str):
+        return self.document("users", user_id)
+
+    def role(self, role_id: str):
+        return self.document("roles", role_id)
+
+    def organization(self, organization_id: Optional[str] = None):
+        return self.document("organizations", organization_id)
+
+    def department(self, department_id: str):
+        return self.document("departments", department_id)
+
+    def task(self, task_id: Optional[str] = None):
+        return self.document("tasks", task_id)
+
+    def workflow(self, workflow_id: str):
+        return self.document("workflows", workflow_id)
+
+    def node(self, node_id: str):
+        return self.document("nodes", node_id)
+
+    def workflow_delete_job(self, job_id: str):
+        return self.document("workflow_delete_jobs", job_id)
+
+    # ------ QUERIES ------
+    def collection(self, collection: str):
+        return self.client.collection(collection)
+
+    def roles(self):
+        return self.collection("roles")
+
+    def users_by_user_id(self, user_id: str):
+        return self.collection("users").where("user_id", "==", user_id)
+
+    def users_by_organization(self, organization_id: str):
+        client = self.client
+        return client.collection("users").where("organization", "==", client.collection("organizations").document(organization_id))
+
+    def departments_by_organization(self, organization_id: str):
+        client = self.client
+        return client.collection("departments").where("organization", "==", client.collection("organizations").document(organization_id))
+
+    def tasks(self, organization_id: str, status: Optional[str] = None, assigned_to_id: Optional[str] = None,
+              department_id: Optional[str] = None, created_by_id: Optional[str] = None):
+        client = self.client
+        query = client.collection("tasks").where("organization", "==", client.collection("organizations").document(organization_id))
+        if status is not None:
+            query = query.where("status", "==", status)
+        if assigned_to_id is not None:
+            query = query.where("assigned_to", "==", client.collection("users").document(assigned_to_id))
+        if department_id is not None:
+            query = query.where("department", "==", client.collection("departments").document(department_id))
+        if created_by_id is not None:
+            query = query.where("created_by", "==", client.collection("users").document(created_by_id))
+        return query
+
+    def workflows_by_organization(self, organization_id: str):
+        client = self.client
+        return client.collection("workflows").where("organization", "==", client.collection("organizations").document(organization_id))
+
+    def nodes_by_workflow(self, workflow_id: str):
+        client = self.client
+        return client.collection("nodes").where("workflow", "==", client.collection("workflows").document(workflow_id))
+
+    def edges_by_workflow(self, workflow_id: str):
+        client = self.client
+        return client.collection("edges").where("workflow", "==", client.collection("workflows").document(workflow_id))
+
+    def messages_by_user(self, user_id: str):
+        client = self.client
+        return (
+            client.collection("ia_answers")
+            .where("user", "==", client.collection("users").document(user_id))
+            .order_by("created_at", direction=firestore.Query.DESCENDING)
+            .order_by("__name__", direction=firestore.Query.DESCENDING)
+        )
+
+    def maps_data(self):
+        return self.collection("maps_data")
+
+    # ------ WRITES ------
+    async def add_user(self, user_data: Dict[str, Any]):
+        return (await self.collection("users").add(user_data))[1]
+
+    async def add_workflow(self, workflow_data: Dict[str, Any]):
+        return (await self.collection("workflows").add(workflow_data))[1]
+
+    async def add_message(self, user_id: str, user_message: str, answer: str):
+        client = self.client
+        return (await client.collection("ia_answers").add({
+            "ia_answer": answer,
+            "user": client.collection("users").document(user_id),
+            "user_message": user_message,
+            "created_at": firestore.SERVER_TIMESTAMP,
+        }))[1]
+
+    def batch(self):
+        return self.client.batch()
+
+    async def get_all(self, references) -> List[firestore.DocumentSnapshot]:
+        return [snapshot async for snapshot in self.client.get_all(references)]
+
+    async def run_transaction(self, function: Callable[..., Awaitable[Any]], *args):
+        # Reruns function when the transaction is aborted by a concurrent write, up to
+        # TRANSACTION_MAX_ATTEMPTS times.
+        client = self.client
+
+        @firestore.async_transactional
+        async def attempt(transaction):
+            return await function(RepositoryTransaction(client, transaction), *args)
+
+        return await attempt(client.transaction(max_attempts=TRANSACTION_MAX_ATTEMPTS))
+
+
+class StorageRepository(FirestoreRepository):
+    def __init__(self, client):
+        super().__init__([client])
+
+    def listener(self) -> "StorageRepository":
+        # The storage client notifies its own listeners of the writes made through it.
+        return self
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        for client in self.clients:
+            client.close()
+
+    async def run_transaction(self, function: Callable[..., Awaitable[Any]], *args):
+        # Commit raises Aborted when a document the transaction read changed before it.
+        client = self.client
+        for attempt in range(TRANSACTION_MAX_ATTEMPTS):
+            transaction = client.transaction()
+            result = await function(RepositoryTransaction(client, transaction), *args)
+            try:
+                await transaction.commit()
+                return result
+            except exceptions.Aborted:
+                if attempt == TRANSACTION_MAX_ATTEMPTS - 1:
+                    raise
+
+
+def create_repository(backend: str, sqlite_path: str, channels: int = 1):
+    if backend == "firestore":
+        # The emulator is served over a single insecure channel.
+        count = 1 if os.getenv("FIRESTORE_EMULATOR_HOST") else channels
+        return FirestoreRepository([firestore.AsyncClient() for _ in range(count)])
+    if backend == "sqlite":
+        return StorageRepository(SQLiteClient(sqlite_path))
+    raise ValueError(f"Unknown storage backend {backend!r}, expected one of {', '.join(STORAGE_BACKENDS)}")
@@ -0,0 +1,59 @@
+import argparse
+import glob
+import os
+import tempfile
+
+import uvicorn
+from dotenv import load_dotenv
+
+
+# Production entry point. Only the worker processes import main.py, so the supervisor stays small and
+# the app module is never imported twice into one interpreter.
+
+load_dotenv()
+
+# Longer than the idle timeout of the load balancers in front (60s on Google Cloud), so they close idle
+# connections first instead of reusing one the server is closing.
+SERVER_KEEP_ALIVE_TIMEOUT = int(os.getenv("SERVER_KEEP_ALIVE_TIMEOUT", "75"))
+# Subscription streams never finish on their own, so shutdown stops waiting for open requests after this.
+SERVER_GRACEFUL_SHUTDOWN_TIMEOUT = int(os.getenv("SERVER_GRACEFUL_SHUTDOWN_TIMEOUT", "30"))
+
+
+def default_workers() -> int:
+    if os.getenv("WEB_CONCURRENCY"):
+        return int(os.getenv("WEB_CONCURRENCY"))
+    # Snapshot listeners on the sqlite backend only see writes made by their own process.
+    if os.getenv("STORAGE_BACKEND") == "sqlite":
+        return 1
+    return os.cpu_count() or 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8080")))
+    parser.add_argument("--workers", type=int, default=default_workers(), help="Worker processes (default: WEB_CONCURRENCY or one per CPU)")
+    parser.add_argument("--reload", action="store_true", help="Restart on code changes, with a single worker (development)")
+    args = parser.parse_args()
+
+    workers = 1 if args.reload else args.workers
+    if workers > 1:
+        # Each worker writes its metrics to files in this directory and /metrics merges them.
+        os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="prometheus-"))
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        for path in glob.glob(os.path.join(os.environ["PROMETHEUS_MULTIPROC_DIR"], "*.db")):
+            os.remove(path)
+
+    uvicorn.run(
+        "main:app",
+        host=args.host,
+        port=args.port,
+        workers=workers,
+        reload=args.reload,
+        timeout_keep_alive=SERVER_KEEP_ALIVE_TIMEOUT,
+        timeout_graceful_shutdown=SERVER_GRACEFUL_SHUTDOWN_TIMEOUT,
+    )
+
+
+if __name__ == "__main__":
+    main()
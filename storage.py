@@ -0,0 +1,789 @@
+import argparse
+import asyncio
+import base64
+import datetime
+import functools
+import queue
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import orjson
+from google.api_core import exceptions
+from google.cloud import firestore
+from google.cloud.firestore_v1 import transforms
+from google.cloud.firestore_v1.aggregation import AggregationResult
+from google.cloud.firestore_v1.base_document import DocumentSnapshot
+from google.cloud.firestore_v1.watch import ChangeType, DocumentChange
+
+
+# Storage backends behind the Firestore client interface main.py is written against: documents and
+# references, filtered/ordered/paginated queries, count aggregations, batches, transactions and snapshot
+# listeners. StorageClient implements that interface once on top of four primitives (read documents,
+# write documents, list query candidates, optionally run a whole query), and SQLiteClient provides them
+# from an embedded, indexed SQLite database.
+
+STORAGE_BACKENDS = ("firestore", "sqlite")
+
+# Fields the API filters and sorts on, per collection. SQLiteClient stores each of them in its own
+# column and creates one index per tuple; filters and sorts on other fields are evaluated in Python.
+SQLITE_INDEXES = {
+    "users": [("user_id",), ("organization",)],
+    "roles": [],
+    "organizations": [],
+    "departments": [("organization",)],
+    "tasks": [
+        ("organization", "title"), ("organization", "status"), ("status", "title"),
+        ("assigned_to", "title"), ("department", "title"), ("created_by", "title"),
+    ],
+    "workflows": [("organization",)],
+    "nodes": [("workflow",)],
+    "edges": [("workflow",)],
+    "ia_answers": [("user", "created_at")],
+    "maps_data": [("country", "city", "route"), ("distributor_type",)],
+}
+
+SQLITE_OPERATORS = {"==": "=", "<": "<", "<=": "<=", ">": ">", ">=": ">=", "in": "IN"}
+SQLITE_MAX_VARIABLES = 900
+WRITE_BATCH_LIMIT = 500
+
+
+def now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def comparable(value):
+    if isinstance(value, (firestore.AsyncDocumentReference, firestore.DocumentReference)):
+        return value.path
+    return value
+
+
+def hashable(value) -> bool:
+    try:
+        hash(value)
+        return True
+    except TypeError:
+        return False
+
+
+def get_field(data: Dict[str, Any], field_path: str):
+    value = data
+    for part in field_path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            raise KeyError(field_path)
+        value = value[part]
+    return value
+
+
+def null_first(value):
+    # Sort key putting explicit nulls before every other value, as Firestore orders them.
+    return (value is not None, value)
+
+
+def has_field(data: Dict[str, Any], field_path: str) -> bool:
+    try:
+        get_field(data, field_path)
+        return True
+    except KeyError:
+        return False
+
+
+def filter_matches(data: Dict[str, Any], field: str, op: str, value) -> bool:
+    try:
+        current = comparable(get_field(data, field))
+    except KeyError:
+        return False
+    value = [comparable(v) for v in value] if isinstance(value, list) else comparable(value)
+    try:
+        if op == "==":
+            return current == value
+        if op == "!=":
+            return current != value
+        if op == "<":
+            return current < value
+        if op == "<=":
+            return current <= value
+        if op == ">":
+            return current > value
+        if op == ">=":
+            return current >= value
+        if op == "in":
+            return current in value
+        if op == "not-in":
+            return current not in value
+        if op == "array-contains":
+            return isinstance(current, list) and value in [comparable(v) for v in current]
+        if op == "array-contains-any":
+            return isinstance(current, list) and any(comparable(v) in value for v in current)
+    except TypeError:
+        return False
+    raise ValueError(f"Unsupported operator {op}")
+
+
+def merged_document(existing: Optional[Dict[str, Any]], data: Dict[str, Any], merge: bool) -> Dict[str, Any]:
+    # Applies server-side transforms and, for merges and updates, dotted field paths and DELETE_FIELD.
+    document = dict(existing) if merge and existing is not None else {}
+    for key, value in data.items():
+        if value is transforms.DELETE_FIELD:
+            document.pop(key, None)
+            continue
+        if value is transforms.SERVER_TIMESTAMP:
+            value = now()
+        elif isinstance(value, transforms.Increment):
+            value = (existing or {}).get(key, 0) + value.value
+        elif isinstance(value, transforms.ArrayUnion):
+            current = list((existing or {}).get(key, []))
+            value = current + [v for v in value.values if v not in current]
+        elif isinstance(value, transforms.ArrayRemove):
+            value = [v for v in (existing or {}).get(key, []) if v not in value.values]
+        if "." in key and merge:
+            head, _, tail = key.partition(".")
+            nested = dict(document.get(head) or {})
+            nested[tail] = value
+            document[head] = nested
+        else:
+            document[key] = value
+    return document
+
+
+class StorageDocumentReference(firestore.AsyncDocumentReference):
+    def collection(self, collection_id):
+        return self._client.collection(*self._path, collection_id)
+
+    async def get(self, field_paths=None, transaction=None, **kwargs):
+        data = (await self._client._run(self._client._read_many, [self.path])).get(self.path)
+        if transaction is not None:
+            transaction._read(self.path, data)
+        return self._client._snapshot(self.path, data, field_paths)
+
+    async def _write(self, operation: str, data, merge: bool):
+        return (await self._client._run(self._client._commit, [(operation, self.path, data, merge)]))[0]
+
+    async def create(self, document_data, **kwargs):
+        return await self._write("create", document_data, False)
+
+    async def set(self, document_data, merge=False, **kwargs):
+        return await self._write("set", document_data, merge)
+
+    async def update(self, field_updates, **kwargs):
+        return await self._write("update", field_updates, True)
+
+    async def delete(self, **kwargs):
+        return await self._write("delete", None, False)
+
+
+class StorageAggregationQuery:
+    def __init__(self, query, alias):
+        self._query = query
+        self._alias = alias or "field_1"
+
+    def _value(self) -> int:
+        count = self._query._client._count(self._query)
+        return len(self._query._select()) if count is None else count
+
+    async def get(self, transaction=None, **kwargs):
+        count = await self._query._client._run(self._value)
+        return [[AggregationResult(alias=self._alias, value=count, read_time=now())]]
+
+
+class StorageWatch:
+    # Runs on the client's notifier thread only: the initial load, then the changes of each later commit.
+    def __init__(self, client, query, callback):
+        self._client = client
+        self._query = query
+        self._callback = callback
+        self._documents = {}
+        self._active = True
+
+    def _initial(self):
+        if not self._active:
+            return
+        self._documents = {snapshot.reference.path: snapshot for snapshot in self._query._matching()}
+        changes = [DocumentChange(ChangeType.ADDED, snapshot, -1, index) for index, snapshot in enumerate(self._documents.values())]
+        self._callback(list(self._documents.values()), changes, now())
+
+    def _changed(self, documents: Dict[str, Optional[Dict[str, Any]]]):
+        if not self._active:
+            return
+        changes = []
+        for path, data in documents.items():
+            previous = self._documents.get(path)
+            if data is not None and all(filter_matches(data, *condition) for condition in self._query._filters):
+                snapshot = self._client._snapshot(path, data, self._query._projection)
+                if previous is not None and previous._data == snapshot._data:
+                    # Already part of the initial load, which can run after the commit was queued.
+                    continue
+                self._documents[path] = snapshot
+                changes.append(DocumentChange(ChangeType.ADDED if previous is None else ChangeType.MODIFIED, snapshot, -1, 0))
+            elif previous is not None:
+                del self._documents[path]
+                changes.append(DocumentChange(ChangeType.REMOVED, previous, 0, -1))
+        if changes:
+            self._callback(list(self._documents.values()), changes, now())
+
+    def unsubscribe(self):
+        self._active = False
+        with self._client._lock:
+            if self in self._client._watches:
+                self._client._watches.remove(self)
+
+
+class StorageQuery:
+    def __init__(self, client, collection_path, filters=(), orders=(), limit=None, projection=None, cursor=None):
+        self._client = client
+        self._collection_path = collection_path
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._projection = projection
+        self._cursor = cursor
+
+    def _copy(self, **changes):
+        state = dict(filters=self._filters, orders=self._orders, limit=self._limit,
+                     projection=self._projection, cursor=self._cursor)
+        state.update(changes)
+        return StorageQuery(self._client, self._collection_path, **state)
+
+    def where(self, field_path=None, op_string=None, value=None, *, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction=firestore.Query.ASCENDING):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def select(self, field_paths):
+        return self._copy(projection=list(field_paths))
+
+    def start_after(self, document_fields_or_snapshot):
+        return self._copy(cursor=document_fields_or_snapshot)
+
+    def count(self, alias=None):
+        return StorageAggregationQuery(self, alias)
+
+    def _full_orders(self):
+        # Firestore breaks ties by document name, in the direction of the last explicit ordering.
+        direction = self._orders[-1][1] if self._orders else firestore.Query.ASCENDING
+        return self._orders + (("__name__", direction),)
+
+    def _select(self) -> List[Tuple[str, Dict[str, Any]]]:
+        items = self._client._execute(self)
+        if items is not None:
+            return items
+        items = [
+            (path, data) for path, data in self._client._candidates(self._collection_path, self._filters)
+            if all(filter_matches(data, field, op, value) for field, op, value in self._filters)
+        ]
+        if self._orders:
+            items = [(path, data) for path, data in items
+                     if all(field == "__name__" or has_field(data, field) for field, _ in self._orders)]
+        for field, direction in reversed(self._full_orders()):
+            items.sort(
+                key=lambda item: item[0] if field == "__name__" else null_first(comparable(get_field(item[1], field))),
+                reverse=direction == firestore.Query.DESCENDING,
+            )
+        if self._cursor is not None:
+            items = self._after_cursor(items)
+        if self._limit is not None:
+            items = items[:self._limit]
+        return items
+
+    def _after_cursor(self, items):
+        cursor = self._cursor
+        if isinstance(cursor, DocumentSnapshot):
+            values = {field: comparable(get_field(cursor._data, field)) for field, _ in self._orders if field != "__name__"}
+            name = cursor.reference.path
+        else:
+            values = {field: comparable(value) for field, value in dict(cursor).items()}
+            name = values.pop("__name__", None)
+            if isinstance(name, str) and "/" not in name:
+                name = f"{self._collection_path}/{name}"
+        orders = self._full_orders() if name else self._orders
+
+        def is_after(path, data):
+            for field, direction in orders:
+                current = path if field == "__name__" else null_first(comparable(get_field(data, field)))
+                target = name if field == "__name__" else null_first(values[field])
+                if current == target:
+                    continue
+                return current > target if direction == firestore.Query.ASCENDING else current < target
+            return False
+
+        return [(path, data) for path, data in items if is_after(path, data)]
+
+    def _matching(self):
+        return [self._client._snapshot(path, data, self._projection) for path, data in self._select()]
+
+    async def stream(self, transaction=None, **kwargs):
+        for snapshot in await self._client._run(self._matching):
+            yield snapshot
+
+    async def get(self, transaction=None, **kwargs):
+        return await self._client._run(self._matching)
+
+    def on_snapshot(self, callback):
+        # Returns at once; like Firestore's, the initial snapshot is delivered in the background.
+        watch = StorageWatch(self._client, self, callback)
+        with self._client._lock:
+            self._client._watches.append(watch)
+            self._client._enqueue(watch._initial)
+        return watch
+
+
+class StorageCollectionReference(StorageQuery):
+    def __init__(self, client, path):
+        super().__init__(client, path)
+
+    @property
+    def id(self):
+        return self._collection_path.rsplit("/", 1)[-1]
+
+    def document(self, document_id=None):
+        if document_id is None:
+            document_id = uuid.uuid4().hex[:20]
+        return self._client.document(f"{self._collection_path}/{document_id}")
+
+    async def add(self, document_data, document_id=None, **kwargs):
+        ref = self.document(document_id)
+        await ref.create(document_data)
+        return now(), ref
+
+    async def list_documents(self, **kwargs):
+        for snapshot in await self._client._run(self._matching):
+            yield snapshot.reference
+
+
+class StorageWriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._operations = []
+
+    def __len__(self):
+        return len(self._operations)
+
+    def create(self, reference, document_data):
+        self._operations.append(("create", reference.path, document_data, False))
+
+    def set(self, reference, document_data, merge=False):
+        self._operations.append(("set", reference.path, document_data, merge))
+
+    def update(self, reference, field_updates, option=None):
+        self._operations.append(("update", reference.path, field_updates, True))
+
+    def delete(self, reference, option=None):
+        self._operations.append(("delete", reference.path, None, False))
+
+    async def commit(self, **kwargs):
+        results = await self._client._run(self._client._commit, self._operations)
+        self._operations = []
+        return results
+
+
+class StorageTransaction(StorageWriteBatch):
+    # Writes are applied atomically on commit, which raises Aborted when a document read through the
+    # transaction changed in the meantime; the caller retries. Query results are not re-checked.
+    def __init__(self, client):
+        super().__init__(client)
+        self._reads = {}
+
+    def _read(self, path: str, data: Optional[Dict[str, Any]]):
+        self._reads.setdefault(path, data)
+
+    async def commit(self, **kwargs):
+        results = await self._client._run(self._client._commit, self._operations, self._reads)
+        self._operations = []
+        self._reads = {}
+        return results
+
+
+class StorageClient:
+    def __init__(self, project: str = "local"):
+        self.project = project
+        self._lock = threading.RLock()
+        self._watches: List[StorageWatch] = []
+        self._notifications = queue.SimpleQueue()
+        self._notifier = None
+
+    def collection(self, *path):
+        return StorageCollectionReference(self, "/".join(path))
+
+    def document(self, *path):
+        return StorageDocumentReference(*"/".join(path).split("/"), client=self)
+
+    def batch(self):
+        return StorageWriteBatch(self)
+
+    def transaction(self, **kwargs):
+        return StorageTransaction(self)
+
+    async def get_all(self, references, field_paths=None, transaction=None, **kwargs):
+        paths = list(dict.fromkeys(ref.path for ref in references))
+        documents = await self._run(self._read_many, paths)
+        for path in paths:
+            if transaction is not None:
+                transaction._read(path, documents.get(path))
+            yield self._snapshot(path, documents.get(path), field_paths)
+
+    def close(self):
+        with self._lock:
+            if self._notifier is not None:
+                self._notifications.put(None)
+                self._notifier = None
+
+    async def _run(self, function, *args):
+        # Runs a storage primitive for an async method; backends doing blocking I/O run it off the loop.
+        return function(*args)
+
+    def _snapshot(self, path: str, data: Optional[Dict[str, Any]], field_paths=None) -> DocumentSnapshot:
+        if data is not None and field_paths is not None:
+            data = {key: value for key, value in data.items() if key in field_paths}
+        timestamp = now()
+        return DocumentSnapshot(self.document(path), data, data is not None, timestamp, timestamp, timestamp)
+
+    def _commit(self, operations, reads: Optional[Dict[str, Optional[Dict[str, Any]]]] = None) -> List[datetime.datetime]:
+        if len(operations) > WRITE_BATCH_LIMIT:
+            raise exceptions.InvalidArgument(f"maximum {WRITE_BATCH_LIMIT} writes allowed per request")
+        reads = reads or {}
+        with self._lock:
+            pending = self._read_many(list(dict.fromkeys([*reads, *(path for _, path, _, _ in operations)])))
+            for path, data in reads.items():
+                if pending.get(path) != data:
+                    raise exceptions.Aborted(f"Document changed since the transaction read it: {path}")
+            for operation, path, data, merge in operations:
+                existing = pending.get(path)
+                if operation == "create" and existing is not None:
+                    raise exceptions.AlreadyExists(f"Document already exists: {path}")
+                if operation == "update" and existing is None:
+                    raise exceptions.NotFound(f"No document to update: {path}")
+                pending[path] = None if operation == "delete" else merged_document(existing, data, merge)
+            changes = {path: pending.get(path) for _, path, _, _ in operations}
+            self._write_many(changes)
+            self._notify(changes)
+        timestamp = now()
+        return [timestamp for _ in operations]
+
+    def _notify(self, changes: Dict[str, Optional[Dict[str, Any]]]):
+        # Called under self._lock, so listeners see commits in order and only those made after they started.
+        by_collection = {}
+        for path, data in changes.items():
+            by_collection.setdefault(path.rsplit("/", 1)[0], {})[path] = data
+        for watch in self._watches:
+            documents = by_collection.get(watch._query._collection_path)
+            if documents:
+                self._enqueue(functools.partial(watch._changed, documents))
+
+    def _enqueue(self, job):
+        # Snapshot listeners run on one background thread, as Firestore's do, never in the writer's call.
+        with self._lock:
+            if self._notifier is None:
+                self._notifier = threading.Thread(target=self._deliver, args=(self._notifications,), name="storage-notifier", daemon=True)
+                self._notifier.start()
+            self._notifications.put(job)
+
+    @staticmethod
+    def _deliver(notifications: queue.SimpleQueue):
+        while True:
+            job = notifications.get()
+            if job is None:
+                return
+            try:
+                job()
+            except Exception:
+                traceback.print_exc()
+
+    def _read_many(self, paths: List[str]) -> Dict[str, Dict[str, Any]]:
+        raise NotImplementedError
+
+    def _write_many(self, changes: Dict[str, Optional[Dict[str, Any]]]):
+        raise NotImplementedError
+
+    def _candidates(self, collection_path: str, filters) -> List[Tuple[str, Dict[str, Any]]]:
+        # Every document the filters could match; StorageQuery re-checks them.
+        raise NotImplementedError
+
+    def _execute(self, query: StorageQuery) -> Optional[List[Tuple[str, Dict[str, Any]]]]:
+        # The final result of the whole query when the backend can compute it natively, else None.
+        return None
+
+    def _count(self, query: StorageQuery) -> Optional[int]:
+        return None
+
+
+def encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return {"$time": value.isoformat()}
+    if isinstance(value, (firestore.AsyncDocumentReference, firestore.DocumentReference)):
+        return {"$ref": value.path}
+    if isinstance(value, firestore.GeoPoint):
+        return {"$geo": [value.latitude, value.longitude]}
+    if isinstance(value, bytes):
+        return {"$bytes": base64.b64encode(value).decode()}
+    raise TypeError(f"Cannot store {type(value).__name__} values")
+
+
+def decode_value(value, client: StorageClient):
+    if isinstance(value, dict):
+        if len(value) == 1:
+            key, item = next(iter(value.items()))
+            if key == "$ref":
+                return client.document(item)
+            if key == "$time":
+                return datetime.datetime.fromisoformat(item)
+            if key == "$geo":
+                return firestore.GeoPoint(*item)
+            if key == "$bytes":
+                return base64.b64decode(item)
+        return {key: decode_value(item, client) for key, item in value.items()}
+    if isinstance(value, list):
+        return [decode_value(item, client) for item in value]
+    return value
+
+
+def column_value(value):
+    # The value stored in an index column: references by path, timestamps as epoch seconds. Values SQLite
+    # cannot compare (maps, arrays, geopoints) are not indexed.
+    value = comparable(value)
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    if isinstance(value, (str, int, float)) or value is None:
+        return value
+    return None
+
+
+def quote(identifier: str) -> str:
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+class SQLiteClient(StorageClient):
+    def __init__(self, path: str, indexes: Optional[Dict[str, List[Tuple[str, ...]]]] = None, project: str = "local"):
+        super().__init__(project)
+        self.path = path
+        self._indexes = SQLITE_INDEXES if indexes is None else indexes
+        self._tables: Dict[str, Tuple[str, Tuple[str, ...]]] = {}
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        # Every SQLite call of the async API runs on this thread, so the event loop never waits on the
+        # disk or on the busy timeout of BEGIN IMMEDIATE. Calls are serialized by self._lock anyway.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def close(self):
+        super().close()
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            self._connection.close()
+
+    def _table(self, collection_path: str) -> Tuple[str, Tuple[str, ...]]:
+        # One table per collection: the encoded document plus one column per indexed field, created and
+        # backfilled on first use so new entries in SQLITE_INDEXES apply to existing databases.
+        table = self._tables.get(collection_path)
+        if table is not None:
+            return table
+        with self._lock:
+            collection_id = collection_path.rsplit("/", 1)[-1]
+            indexes = self._indexes.get(collection_id, [])
+            fields = tuple(dict.fromkeys(field for index in indexes for field in index))
+            name = quote(collection_path)
+            connection = self._connection
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {name} (id TEXT PRIMARY KEY, data BLOB NOT NULL)")
+            existing = {row[1] for row in connection.execute(f"PRAGMA table_info({name})")}
+            missing = [field for field in fields if f"f.{field}" not in existing]
+            if missing:
+                connection.execute("BEGIN IMMEDIATE")
+                try:
+                    for field in missing:
+                        connection.execute(f"ALTER TABLE {name} ADD COLUMN {quote('f.' + field)}")
+                    assignments = ", ".join(f"{quote('f.' + field)} = ?" for field in missing)
+                    rows = connection.execute(f"SELECT id, data FROM {name}").fetchall()
+                    connection.executemany(
+                        f"UPDATE {name} SET {assignments} WHERE id = ?",
+                        [(*self._columns(self._decode(data), missing), doc_id) for doc_id, data in rows],
+                    )
+                    connection.execute("COMMIT")
+                except BaseException:
+                    connection.execute("ROLLBACK")
+                    raise
+            for index in indexes:
+                index_name = quote(f"{collection_path}:{','.join(index)}")
+                columns = ", ".join(quote("f." + field) for field in index)
+                connection.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {name} ({columns})")
+            table = self._tables[collection_path] = (name, fields)
+        return table
+
+    def _encode(self, data: Dict[str, Any]) -> bytes:
+        return orjson.dumps(data, default=encode_value, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+    def _decode(self, raw) -> Dict[str, Any]:
+        return decode_value(orjson.loads(raw), self)
+
+    @staticmethod
+    def _columns(data: Dict[str, Any], fields) -> List[Any]:
+        values = []
+        for field in fields:
+            try:
+                values.append(column_value(get_field(data, field)))
+            except KeyError:
+                values.append(None)
+        return values
+
+    def _read_many(self, paths: List[str]) -> Dict[str, Dict[str, Any]]:
+        by_collection = {}
+        for path in paths:
+            collection_path, _, doc_id = path.rpartition("/")
+            by_collection.setdefault(collection_path, []).append(doc_id)
+        documents = {}
+        with self._lock:
+            for collection_path, ids in by_collection.items():
+                name, _ = self._table(collection_path)
+                for start in range(0, len(ids), SQLITE_MAX_VARIABLES):
+                    chunk = ids[start:start + SQLITE_MAX_VARIABLES]
+                    rows = self._connection.execute(
+                        f"SELECT id, data FROM {name} WHERE id IN ({', '.join('?' * len(chunk))})", chunk
+                    ).fetchall()
+                    for doc_id, data in rows:
+                        documents[f"{collection_path}/{doc_id}"] = self._decode(data)
+        return documents
+
+    def _write_many(self, changes: Dict[str, Optional[Dict[str, Any]]]):
+        with self._lock:
+            connection = self._connection
+            statements = []
+            for path, data in changes.items():
+                collection_path, _, doc_id = path.rpartition("/")
+                name, fields = self._table(collection_path)
+                if data is None:
+                    statements.append((f"DELETE FROM {name} WHERE id = ?", (doc_id,)))
+                else:
+                    columns = "".join(f", {quote('f.' + field)}" for field in fields)
+                    placeholders = ", ?" * (len(fields) + 2)
+                    statements.append((
+                        f"INSERT OR REPLACE INTO {name} (id, data{columns}) VALUES ({placeholders[2:]})",
+                        (doc_id, self._encode(data), *self._columns(data, fields)),
+                    ))
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                for sql, parameters in statements:
+                    connection.execute(sql, parameters)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def _where(self, fields: Tuple[str, ...], filters) -> Tuple[List[str], List[Any], bool]:
+        clauses, parameters, residual = [], [], False
+        for field, op, value in filters:
+            values = value if op == "in" and isinstance(value, (list, tuple)) else [value]
+            converted = [column_value(item) for item in values]
+            if field not in fields or op not in SQLITE_OPERATORS or any(item is None for item in converted):
+                residual = True
+                continue
+            if op == "in":
+                clauses.append(f"{quote('f.' + field)} IN ({', '.join('?' * len(converted))})")
+            else:
+                clauses.append(f"{quote('f.' + field)} {SQLITE_OPERATORS[op]} ?")
+            parameters.extend(converted)
+        return clauses, parameters, residual
+
+    def _rows(self, collection_path: str, sql: str, parameters) -> List[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            rows = self._connection.execute(sql, parameters).fetchall()
+        return [(f"{collection_path}/{doc_id}", self._decode(data)) for doc_id, data in rows]
+
+    def _candidates(self, collection_path: str, filters) -> List[Tuple[str, Dict[str, Any]]]:
+        name, fields = self._table(collection_path)
+        clauses, parameters, _ = self._where(fields, filters)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        return self._rows(collection_path, f"SELECT id, data FROM {name}{where}", parameters)
+
+    def _execute(self, query: StorageQuery) -> Optional[List[Tuple[str, Dict[str, Any]]]]:
+        # Runs filters, ordering and limit in SQLite when every filter and sort field is indexed; cursors
+        # fall back to StorageQuery, which still narrows candidates through the indexed filters.
+        if query._cursor is not None:
+            return None
+        name, fields = self._table(query._collection_path)
+        clauses, parameters, residual = self._where(fields, query._filters)
+        if residual:
+            return None
+        order_terms = []
+        for field, direction in query._full_orders():
+            if field == "__name__":
+                column = "id"
+            elif field in fields:
+                column = quote("f." + field)
+                # Like Firestore, documents without the field are left out and an explicit null is kept;
+                # the column is NULL for both, so the document itself tells them apart.
+                path = "$" + "".join(f'."{part}"' for part in field.split("."))
+                clauses.append(f"({column} IS NOT NULL OR json_type(CAST(data AS TEXT), ?) IS NOT NULL)")
+                parameters.append(path)
+            else:
+                return None
+            order_terms.append(f"{column} {'DESC' if direction == firestore.Query.DESCENDING else 'ASC'}")
+        sql = f"SELECT id, data FROM {name}"
+        if clauses:
+            sql += f" WHERE {' AND '.join(clauses)}"
+        sql += f" ORDER BY {', '.join(order_terms)}"
+        if query._limit is not None:
+            sql += " LIMIT ?"
+            parameters.append(query._limit)
+        return self._rows(query._collection_path, sql, parameters)
+
+    def document_paths(self, collection_path: str) -> List[str]:
+        name, _ = self._table(collection_path)
+        with self._lock:
+            return [f"{collection_path}/{row[0]}" for row in self._connection.execute(f"SELECT id FROM {name}")]
+
+    def _count(self, query: StorageQuery) -> Optional[int]:
+        if query._cursor is not None or query._limit is not None:
+            return None
+        name, fields = self._table(query._collection_path)
+        clauses, parameters, residual = self._where(fields, query._filters)
+        if residual:
+            return None
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            return self._connection.execute(f"SELECT COUNT(*) FROM {name}{where}", parameters).fetchone()[0]
+
+
+def replicate(source: firestore.Client, target: SQLiteClient, collection: str, batch_size: int = WRITE_BATCH_LIMIT) -> int:
+    # Copies a Firestore collection into the SQLite database, replacing documents with the same id.
+    # Documents deleted in Firestore since the last run are removed as well.
+    copied = 0
+    seen = set()
+    operations = []
+    for snapshot in source.collection(collection).stream():
+        seen.add(snapshot.reference.path)
+        operations.append(("set", snapshot.reference.path, snapshot.to_dict(), False))
+        if len(operations) == batch_size:
+            target._commit(operations)
+            copied += len(operations)
+            operations = []
+    stale = [path for path in target.document_paths(collection) if path not in seen]
+    operations += [("delete", path, None, False) for path in stale]
+    for start in range(0, len(operations), batch_size):
+        target._commit(operations[start:start + batch_size])
+    return copied + len(operations) - len(stale)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replicate Firestore collections into the SQLite storage backend.")
+    parser.add_argument("collections", nargs="*", default=["maps_data"])
+    parser.add_argument("--path", default="storage.sqlite3", help="SQLite database file")
+    args = parser.parse_args()
+
+    source_client = firestore.Client()
+    target_client = SQLiteClient(args.path)
+    for collection_id in args.collections:
+        started = time.perf_counter()
+        count = replicate(source_client, target_client, collection_id)
+        print(f"{collection_id}: {count} documents in {time.perf_counter() - started:.1f}s")
+    target_client.close()